@@ -1,38 +1,248 @@
 import datetime
-import runpy
+import os
+import random
+import sys
 import time
 from pathlib import Path
+from typing import Optional
 
 import click
+import pandas as pd
 import rich
 
-from admeasure_py.utils import AWS_REGIONS, DIGITALOCEAN_REGIONS, bash, get_from_s3, get_resource_url, normalize_id, \
-    run, s3_bucket, spawn_runner, timeit, json
+from admeasure_py import bench, mapreduce, profiling, zdict
+from admeasure_py.blobs import HarStore, dedup_summary, store_path
+from admeasure_py.bulk import delete_prefix, upload_files
+from admeasure_py.index import lookup_url, update_index
+from admeasure_py.packed import PackedStore, pack_directory
+from admeasure_py.pipeline import pipeline_options
+from admeasure_py.stages import Memo
+from admeasure_py.utils import AWS_REGIONS, DIGITALOCEAN_REGIONS, analysis, bash, get_from_s3, get_resource_url, \
+    list_objects, normalize_id, run, spawn_runner, timeit, json
 
 here = Path(__file__).parent
 
 
 @click.group()
-def cli():
-    pass
+@click.option("--profile", type=click.Path(dir_okay=False, path_type=Path),
+              help="write a profiling summary (JSON) and a Chrome trace (*.trace.json) to this path.")
+@click.pass_context
+def cli(ctx, profile):
+    if profile:
+        profiling.enable()
+
+        @ctx.call_on_close
+        def write_profile():
+            summary, trace = profiling.export(profile)
+            print(f"Profile written to {summary} and {trace}.", file=sys.stderr)
 
 
 # go ahead, judge me :D
 for x in ["button-texts", "consent-test", "log", "eval"]:
     try:
-        cli.add_command(runpy.run_path(here / f"../{x}/run.py")["cli"], x)
+        cli.add_command(analysis(x)["cli"], x)
     except FileNotFoundError:
         pass
 
+cli.add_command(bench.cli, "bench")
+
+
 @cli.command()
 @click.argument("id")
 def url(id):
     id = normalize_id(id)
     plan_id, _, step = id.rpartition("/")
     part, _, i = step.partition("-")
-    part_data = json.loads(get_from_s3(f"{plan_id}/{part}.json"))
-    url = part_data["urls"][int(i)]
-    print(url)
+    try:
+        print(lookup_url(plan_id, part, int(i)))
+    except LookupError as e:
+        raise click.ClickException(str(e))
+
+
+@cli.group("index")
+def index():
+    pass
+
+
+@index.command()
+@click.argument("prefix")
+@click.option("--urls/--no-urls", default=True, help="also fetch {part}.json for plans with sampled URLs.")
+def update(prefix, urls):
+    """index all plans under prefix that are not yet known."""
+    update_index(prefix, urls)
+
+
+@cli.group("cache")
+def cache():
+    pass
+
+
+@cache.command()
+@click.argument("directory", type=click.Path(exists=True, file_okay=False, path_type=Path))
+def pack(directory):
+    """copy a file-per-object cache directory into a packed store (<directory>.pack)."""
+    with PackedStore(directory.with_name(f"{directory.name}.pack")) as store:
+        added = pack_directory(directory, store)
+        print(f"Packed {added} new objects, {len(store)} in {store.directory}.")
+
+
+@cli.group("har")
+def har():
+    pass
+
+
+def _har_keys(prefix: str) -> list[str]:
+    return sorted(o.key for o in list_objects(prefix) if o.key.endswith("/requests.har"))
+
+
+@har.command()
+@click.argument("prefix")
+@click.option("--store", type=click.Path(file_okay=False, path_type=Path), default=store_path, show_default=True)
+def dedup(prefix, store):
+    """store the response bodies of all HARs under prefix once, by content hash."""
+    keys = _har_keys(prefix)
+    with HarStore(store) as s, timeit(f"ingesting {len(keys)} HARs"):
+        stats = s.ingest_from_s3(keys)
+    if not stats:
+        print("All HARs already ingested.")
+        return
+    with pd.option_context("display.max_rows", None, "display.width", None):
+        print(dedup_summary(stats))
+
+
+@har.command()
+@click.argument("prefix")
+@click.option("--store", type=click.Path(file_okay=False, path_type=Path), default=store_path, show_default=True)
+@click.option("--per-site", is_flag=True, help="one row per site instead of per run (e.g. for adm eval effects).")
+@click.option("-o", "--output", type=click.Path(dir_okay=False, path_type=Path), help="write the counts as CSV.")
+def keywords(prefix, store, per_site, output):
+    """keyword hits per run, scanning every unique response body only once."""
+    keys = _har_keys(prefix)
+    with HarStore(store) as s:
+        s.ingest_from_s3(keys)
+        counts = s.keyword_counts(keys, Memo(s.directory / "stages.sqlite"), per_site)
+    if output:
+        counts.to_csv(output)
+    print(counts if per_site else counts.T.to_string())
+
+
+@cli.group("mapreduce")
+def mapreduce_():
+    pass
+
+
+def _write_frames(frames: dict[str, pd.DataFrame], output: Optional[Path]) -> None:
+    mapreduce.summarize(frames)
+    if output:
+        output.mkdir(parents=True, exist_ok=True)
+        for name, df in frames.items():
+            df.to_csv(output / f"{name}.csv")
+        print(f"Results written to {output}.")
+
+
+@mapreduce_.command("run")
+@click.argument("analysis_", metavar="ANALYSIS", type=click.Choice(list(mapreduce.MAPPERS)))
+@click.argument("prefix")
+@click.option("--shards", type=int, help="number of shards (default: one per worker process or VM).")
+@click.option("--processes", default=os.cpu_count(), show_default=True, help="local worker processes.")
+@click.option("--vms", type=int, help="run the shards on this many analysis VMs instead (needs an s3:// exchange).")
+@click.option("--exchange", default=str(mapreduce.default_exchange), show_default=True,
+              help="local directory or s3://prefix for manifests and partials.")
+@click.option("--job", help="job name (default: analysis and current time).")
+@click.option("--timeout", default=6 * 3600, show_default=True, help="seconds to wait for VMs.")
+@click.option("-o", "--output", type=click.Path(file_okay=False, path_type=Path), help="write one CSV per table.")
+@click.option("--verify", is_flag=True, help="also compute everything on a single node and compare.")
+@pipeline_options
+def mapreduce_run(analysis_, prefix, shards, processes, vms, exchange, job, timeout, output, verify, download_workers,
+                  workers):
+    """run ANALYSIS sharded over the runs below PREFIX (the prefixes one level below, or PREFIX if it is a run)."""
+    exchange = mapreduce.Exchange(exchange)
+    job = job or f"{analysis_}-{datetime.datetime.utcnow().strftime('%Y-%m-%dT%H-%M-%S')}"
+    manifest = mapreduce.plan_job(exchange, job, analysis_, normalize_id(prefix), shards or vms or processes)
+    n = len(manifest["shards"])
+    print(f"{job}: {sum(map(len, manifest['shards']))} runs in {n} shards.")
+
+    with timeit(f"{job}: map"):
+        if vms:
+            for shard in range(n):
+                mapreduce.spawn_analysis_worker(exchange, job, shard)
+            mapreduce.wait_for_partials(exchange, job, n, timeout)
+        else:
+            mapreduce.run_local(exchange, job, n, processes, download_workers, workers)
+    merged = mapreduce.reduce(exchange, job)
+    _write_frames(mapreduce.to_frames(merged), output)
+
+    if verify:
+        with timeit("single-node run"):
+            single = mapreduce.MAPPERS[analysis_]([normalize_id(prefix)], download_workers, workers)
+        if not mapreduce.counts_equal(merged, single):
+            raise click.ClickException("merged result differs from the single-node run.")
+        print("merged result equals the single-node run.")
+
+
+@mapreduce_.command("work")
+@click.argument("exchange")
+@click.argument("job")
+@click.argument("shard", type=int, nargs=-1, required=True)
+@pipeline_options
+def mapreduce_work(exchange, job, shard, download_workers, workers):
+    """compute the partials of the given shards of a job."""
+    for s in shard:
+        mapreduce.work(mapreduce.Exchange(exchange), job, s, download_workers, workers)
+
+
+@mapreduce_.command("fail")
+@click.argument("exchange")
+@click.argument("job")
+@click.argument("shard", type=int)
+@click.option("--log", type=click.Path(dir_okay=False, path_type=Path), help="send the end of this log file along.")
+def mapreduce_fail(exchange, job, shard, log):
+    """mark a shard as failed, so that mapreduce run stops waiting for it."""
+    text = log.read_text("utf8", errors="replace")[-10_000:] if log and log.exists() else ""
+    mapreduce.mark_failed(mapreduce.Exchange(exchange), job, shard, text)
+
+
+@mapreduce_.command("reduce")
+@click.argument("exchange")
+@click.argument("job")
+@click.option("-o", "--output", type=click.Path(file_okay=False, path_type=Path), help="write one CSV per table.")
+def mapreduce_reduce(exchange, job, output):
+    """merge the partials of a job, e.g. after starting workers by hand."""
+    _write_frames(mapreduce.to_frames(mapreduce.reduce(mapreduce.Exchange(exchange), job)), output)
+
+
+@cli.group("zdict")
+def zdict_():
+    pass
+
+
+@zdict_.command()
+@click.argument("directory", type=click.Path(exists=True, file_okay=False, path_type=Path))
+@click.option("--artifact", "artifacts", multiple=True, default=zdict.ARTIFACTS, show_default=True)
+@click.option("--samples", default=5000, show_default=True, help="maximum number of sample files per artifact.")
+@click.option("--size", default=zdict.DICT_SIZE, show_default=True, help="dictionary size in bytes.")
+def train(directory, artifacts, samples, size):
+    """train one dictionary per artifact type from the files of a sample run."""
+    for artifact in artifacts:
+        files = sorted(directory.rglob(artifact))
+        if not files:
+            print(f"{artifact}: no samples found.")
+            continue
+        files = random.Random(0).sample(files, min(samples, len(files)))
+        with timeit(f"{artifact}: training on {len(files)} samples"):
+            d = zdict.train([zdict.decode(f.read_bytes()) for f in files], size)
+        print(f"{artifact}: dictionary {d.dict_id()} written to {zdict.save_dictionary(artifact, d)}")
+
+
+@zdict_.command()
+@click.argument("directory", type=click.Path(exists=True, file_okay=False, path_type=Path))
+@click.option("--dry-run", is_flag=True)
+def recompress(directory, dry_run):
+    """recompress a file-per-object cache (or corpus) in place with the trained dictionaries."""
+    with timeit("recompressing"):
+        files = [f for f in directory.rglob("*") if f.is_file()]
+        count, before, after = zdict.recompress_files(files, dry_run)
+    print(f"{count} files: {before / 1024 ** 2:.1f}MB -> {after / 1024 ** 2:.1f}MB ({after / max(before, 1):.1%})")
 
 
 @cli.group("vm")
@@ -125,21 +335,21 @@ def get(filename, id, pretty):
 
 @s3.command("delete")
 @click.argument("prefix")
-def rm(prefix):
+@click.option("--workers", default=16, show_default=True)
+@click.option("--dry-run", is_flag=True, help="only list and count what would be deleted.")
+def rm(prefix, workers, dry_run):
     """empty the bucket, fast."""
-    click.confirm(f"Delete everything under {prefix!r}?", abort=True)
-    bucket = s3_bucket()
-    with timeit("Deleting..."):
-        bucket.objects.filter(Prefix=prefix).delete()
+    if not dry_run:
+        click.confirm(f"Delete everything under {prefix!r}?", abort=True)
+    delete_prefix(prefix, workers, dry_run)
 
 
 @s3.command()
 @click.argument("filename", nargs=-1)
-def resource_upload(filename):
-    bucket = s3_bucket()
-    for f in filename:
-        with timeit(f):
-            bucket.upload_file(f, f"resources/{f}", ExtraArgs={'ACL': 'public-read'})
+@click.option("--workers", default=4, show_default=True)
+@click.option("--dry-run", is_flag=True)
+def resource_upload(filename, workers, dry_run):
+    upload_files(filename, "resources/", {'ACL': 'public-read'}, workers, dry_run)
 
 
 @s3.command()
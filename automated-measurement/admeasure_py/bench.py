@@ -0,0 +1,325 @@
+"""
+Benchmarks over the checked-in log cache corpus (log/cache/consent-test/) and synthetic consent data.
+
+    adm bench run --save              # run everything, store results in bench-results/
+    adm bench run -k fast_re          # only benchmarks containing "fast_re"
+    adm bench compare old.json new.json --threshold 0.1
+"""
+import contextlib
+import datetime
+import gzip
+import importlib.util
+import platform
+import random
+import re
+import statistics
+import subprocess
+import tempfile
+import time
+from collections.abc import Callable
+from functools import cache
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Optional
+
+import click
+import pandas as pd
+
+from admeasure_py import zdict
+from admeasure_py.packed import PackedStore, pack_directory
+from admeasure_py.utils import analysis, domain_from_url, json, normalize_id, psl
+
+here = Path(__file__).parent
+
+corpus_dir = here / "../log/cache"
+results_dir = here / "../bench-results"
+
+# number of synthetic sites for consent-test.analyze, see --sites
+bench_sites = 100_000
+
+# name -> setup function returning (fn to time, units processed per call, unit[, extra metrics])
+Setup = Callable[[], tuple[Callable[[], Any], int, str]]
+BENCHMARKS: dict[str, Setup] = {}
+# resources of the running benchmark (e.g. temporary directories), released after it ran
+resources = contextlib.ExitStack()
+
+
+def benchmark(name: str) -> Callable[[Setup], Setup]:
+    def register(setup: Setup) -> Setup:
+        BENCHMARKS[name] = setup
+        return setup
+
+    return register
+
+
+@cache
+def corpus() -> dict[str, Path]:
+    """S3 key -> local path for all console.json files in the corpus."""
+    return {
+        normalize_id(str(p.relative_to(corpus_dir))) + "/console.json": p
+        for p in sorted(corpus_dir.glob("consent-test/*/*/console.json"))
+    }
+
+
+@cache
+def corpus_bytes() -> list[bytes]:
+    """decompressed, the corpus may have been recompressed (see adm zdict recompress)"""
+    return [zdict.decode(p.read_bytes()) for p in corpus().values()]
+
+
+@cache
+def corpus_urls() -> list[str]:
+    return [
+        m.decode()
+        for data in corpus_bytes()
+        for m in re.findall(rb"https?://[^\s\"'\\)]+", data)
+    ]
+
+
+@benchmark("json.console")
+def _json_loads():
+    data = corpus_bytes()
+    return lambda: [json.loads(d) for d in data], sum(map(len, data)), "B"
+
+
+def _count_matches(name: str) -> Setup:
+    def setup():
+        from admeasure_py import fast_re
+        fn = getattr(fast_re, name)
+        data = corpus_bytes()
+        return lambda: [fn(d) for d in data], sum(map(len, data)), "B"
+
+    return setup
+
+
+benchmark("fast_re.re")(_count_matches("_count_matches_re"))
+if importlib.util.find_spec("hyperscan"):
+    benchmark("fast_re.hyperscan")(_count_matches("_count_matches_hyperscan"))
+
+
+@benchmark("cache.files")
+def _cache_files():
+    files = list(corpus().values())
+    return lambda: [zdict.decode(f.read_bytes()) for f in files], len(files), "files"
+
+
+@benchmark("cache.packed")
+def _cache_packed():
+    tmp = Path(resources.enter_context(tempfile.TemporaryDirectory()))
+    store = resources.enter_context(PackedStore(tmp))
+    pack_directory(corpus_dir, store)
+    files = [store.file(k) for k in corpus()]
+    return lambda: [f.read_bytes() for f in files], len(files), "files"
+
+
+def _corpus_split() -> tuple[list[bytes], list[bytes]]:
+    """train/test split of the corpus for dictionary compression."""
+    data = corpus_bytes()
+    return data[::2], data[1::2]
+
+
+@benchmark("decode.gzip")
+def _decode_gzip():
+    _, test = _corpus_split()
+    compressed = [gzip.compress(d, compresslevel=9) for d in test]
+    info = {"ratio": sum(map(len, compressed)) / sum(map(len, test))}
+    return lambda: [gzip.decompress(c) for c in compressed], sum(map(len, test)), "B", info
+
+
+def _decode_zstd_dict():
+    train, test = _corpus_split()
+    d = zdict.train(train)
+    compressed = [zdict.compress(t, d) for t in test]
+    decompressor = zdict.zstandard.ZstdDecompressor(dict_data=d)
+    info = {"ratio": sum(map(len, compressed)) / sum(map(len, test))}
+    return lambda: [decompressor.decompress(c) for c in compressed], sum(map(len, test)), "B", info
+
+
+if zdict.zstandard is not None:
+    benchmark("decode.zstd_dict")(_decode_zstd_dict)
+
+
+@benchmark("domain_from_url")
+def _domain_from_url():
+    urls = corpus_urls()
+    return lambda: [domain_from_url(u) for u in urls], len(urls), "urls"
+
+
+@benchmark("psl.get_sld")
+def _psl():
+    domains = [domain_from_url(u) for u in corpus_urls()]
+    p = psl()
+    return lambda: [p.get_sld(d) for d in domains], len(domains), "domains"
+
+
+@benchmark("normalize_id")
+def _normalize_id():
+    paths = [str(p) for p in corpus().values()]
+    return lambda: [normalize_id(p) for p in paths], len(paths), "ids"
+
+
+def corpus_objects() -> list[SimpleNamespace]:
+    """the corpus as listed S3 objects, fetch finds all of them in the corpus cache (see download_file)"""
+    return [SimpleNamespace(key=key) for key in corpus()]
+
+
+@benchmark("log.grep")
+def _log_grep():
+    grep_logs = analysis("log")["grep_logs"]
+    objects = corpus_objects()
+    return lambda: grep_logs("tcf", corpus_dir, objects, 10, 4), len(objects), "files"
+
+
+@benchmark("log.show")
+def _log_show():
+    read_logs = analysis("log")["read_logs"]
+    objects = corpus_objects()
+
+    def show():
+        return [f"\n[{l['part']}] {l['text']}" for l in read_logs(corpus_dir, objects, 10, 4)]
+
+    return show, len(objects), "files"
+
+
+def synthetic_consent_records(sites: int, seed: int = 0) -> tuple[list[dict], pd.DataFrame]:
+    """Consent records and plan attributes shaped like a consent-test run with the given number of sites."""
+    rng = random.Random(seed)
+    plans = pd.DataFrame([
+        {"id": f"consent-test/synthetic-{i:02d}", "region": region, "device": device}
+        for i, (region, device) in enumerate(
+            (r, d)
+            for r in ["eu-central-1", "eu-west-1"]
+            for d in ["chromium", "firefox", "webkit", "chromium"]
+            for _ in range(6)
+        )
+    ]).set_index("id")
+    plan_ids = list(plans.index)
+    records = []
+    for i in range(sites):
+        plan_id = rng.choice(plan_ids)
+        cmp_id = rng.choice([6, 10, 28, 28, 7])
+        tc = {"cmpId": cmp_id} if rng.random() < .9 else {}
+        records.append({
+            "version": 2,
+            "id": f"{plan_id}/measure-{i}",
+            "plan_id": plan_id,
+            "url": f"https://site-{i}.example/",
+            "strategy": rng.choice(["consent_accept", "consent_reject"]),
+            "consent": rng.choice([True, False, None]),
+            "legInt": rng.choice([True, False, None]),
+            "cmpId": cmp_id if tc else None,
+            "tcData": {"tcloaded": tc},
+            "pingLoaded": {"cmpId": cmp_id},
+            "pingWaiting": None,
+        })
+    return records, plans
+
+
+@benchmark("consent-test.analyze")
+def _consent_test_analyze():
+    ct = analysis("consent-test")
+    records, plans = synthetic_consent_records(bench_sites)
+
+    def analyze():
+        df = ct["results_frame"]([dict(r) for r in records], plans)
+        return ct["outcome_distribution"](df)
+
+    return analyze, len(records), "sites"
+
+
+def run_benchmarks(names: list[str], repeat: int) -> dict[str, dict[str, Any]]:
+    results = {}
+    for name in names:
+        with resources:
+            fn, units, unit, *info = BENCHMARKS[name]()
+            fn()  # warm-up
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                fn()
+                times.append(time.perf_counter() - start)
+        median = statistics.median(times)
+        results[name] = {
+            "min": min(times),
+            "median": median,
+            "runs": repeat,
+            "units": units,
+            "unit": unit,
+            "throughput": units / median,
+            **(info[0] if info else {}),
+        }
+        print(f"{name:<24} {median * 1000:10.2f}ms {units / median:14,.0f} {unit}/s", *(
+            f"{k}={v:.3f}" for k, v in (info[0] if info else {}).items()
+        ))
+    return results
+
+
+def compare(old: dict[str, Any], new: dict[str, Any], threshold: float) -> list[str]:
+    """Print median changes per benchmark, return the names of all that got slower by more than threshold."""
+    regressions = []
+    for name, r in new["results"].items():
+        if name not in old["results"]:
+            continue
+        ratio = r["median"] / old["results"][name]["median"]
+        regressed = ratio > 1 + threshold
+        if regressed:
+            regressions.append(name)
+        click.secho(
+            f"{name:<24} {old['results'][name]['median'] * 1000:10.2f}ms -> {r['median'] * 1000:10.2f}ms ({ratio - 1:+.1%})",
+            fg="red" if regressed else ("green" if ratio < 1 - threshold else None),
+        )
+    return regressions
+
+
+def _git_revision() -> Optional[str]:
+    proc = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=here, capture_output=True, text=True)
+    return proc.stdout.strip() or None
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command("run")
+@click.option("-k", "keyword", help="only run benchmarks whose name contains this.")
+@click.option("--repeat", default=5, show_default=True)
+@click.option("--sites", default=bench_sites, show_default=True, help="synthetic sites for consent-test.analyze")
+@click.option("--save", is_flag=True, help="store results in bench-results/.")
+@click.option("--baseline", type=click.File("rb"), help="compare against a previous result file.")
+@click.option("--threshold", default=0.1, show_default=True, help="relative slowdown that counts as regression.")
+def run_cmd(keyword, repeat, sites, save, baseline, threshold):
+    global bench_sites
+    bench_sites = sites
+    names = [n for n in BENCHMARKS if not keyword or keyword in n]
+    print(f"{len(corpus())} corpus files, {sum(map(len, corpus_bytes())) / 1024 ** 2:.1f}MB")
+    result = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.node(),
+        "results": run_benchmarks(names, repeat),
+    }
+    if save:
+        results_dir.mkdir(exist_ok=True)
+        out = results_dir / f"{result['timestamp'].replace(':', '-')}.json"
+        out.write_bytes(json.dumps(result, option=json.OPT_INDENT_2))
+        print(f"Results written to {out.resolve()}")
+    if baseline:
+        if compare(json.loads(baseline.read()), result, threshold):
+            raise click.ClickException("performance regression")
+
+
+@cli.command("compare")
+@click.argument("old", type=click.File("rb"))
+@click.argument("new", type=click.File("rb"))
+@click.option("--threshold", default=0.1, show_default=True)
+def compare_cmd(old, new, threshold):
+    if compare(json.loads(old.read()), json.loads(new.read()), threshold):
+        raise click.ClickException("performance regression")
+
+
+@cli.command("list")
+def list_cmd():
+    for name in BENCHMARKS:
+        print(name)
@@ -0,0 +1,161 @@
+"""
+Content-addressed deduplication of HAR response bodies.
+
+Every response body is stored once in a blob store (a PackedStore keyed by "sha256:<hex>"),
+and the HAR entry references it through a custom `_blob` field instead of carrying `text`:
+
+    "content": {"mimeType": "application/json", "size": 1234, "_blob": "sha256:9f86d0..."}
+
+Rewritten HARs are kept in a second PackedStore keyed by their S3 key.
+"""
+import concurrent.futures
+import copy
+import hashlib
+import os
+from collections.abc import Iterable
+from pathlib import Path
+from typing import TypedDict
+
+import pandas as pd
+
+from admeasure_py import profiling
+from admeasure_py.packed import PackedStore
+from admeasure_py.stages import Memo
+from admeasure_py.utils import get_from_s3, json
+
+
+class DedupStats(TypedDict):
+    entries: int
+    bodies: int
+    new_bodies: int
+    body_bytes: int
+    new_body_bytes: int
+
+
+def store_path() -> Path:
+    if p := os.environ.get("ADMEASURE_HAR_STORE"):
+        return Path(p)
+    return Path.home() / ".cache" / "admeasure" / "har"
+
+
+def run_id(key: str) -> str:
+    """{run_id}/{part-i}/requests.har -> run_id"""
+    return key.rpartition("/")[0].rpartition("/")[0]
+
+
+class HarStore:
+    directory: Path
+    blobs: PackedStore
+    hars: PackedStore
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.blobs = PackedStore(self.directory / "blobs")
+        self.hars = PackedStore(self.directory / "hars")
+
+    def put_blob(self, data: bytes) -> tuple[str, bool]:
+        """
+        Store data if it is not known yet. Returns its address and whether it was new.
+        The store may be shared by several processes (see mapreduce.run_local), so the final check is under its lock.
+        """
+        digest = f"sha256:{hashlib.sha256(data).hexdigest()}"
+        if digest in self.blobs:
+            return digest, False
+        return digest, self.blobs.put(digest, data, if_absent=True)
+
+    def ingest(self, har: dict) -> tuple[dict, DedupStats]:
+        """Move all response bodies of a HAR into the blob store, return the rewritten HAR."""
+        stats = DedupStats(entries=0, bodies=0, new_bodies=0, body_bytes=0, new_body_bytes=0)
+        har = copy.deepcopy(har)
+        for entry in har["log"]["entries"]:
+            stats["entries"] += 1
+            content = entry["response"]["content"]
+            text = content.pop("text", None)
+            if text is None:
+                continue
+            body = text.encode()
+            digest, new = self.put_blob(body)
+            content["_blob"] = digest
+            stats["bodies"] += 1
+            stats["body_bytes"] += len(body)
+            if new:
+                stats["new_bodies"] += 1
+                stats["new_body_bytes"] += len(body)
+        return har, stats
+
+    def inflate(self, har: dict) -> dict:
+        """Restore the original HAR, with bodies inlined again."""
+        har = copy.deepcopy(har)
+        for entry in har["log"]["entries"]:
+            content = entry["response"]["content"]
+            if (digest := content.pop("_blob", None)) is not None:
+                content["text"] = self.blobs[digest].decode()
+        return har
+
+    def har(self, key: str) -> dict:
+        return json.loads(self.hars[key])
+
+    def ingest_from_s3(self, keys: Iterable[str]) -> dict[str, DedupStats]:
+        """Fetch and ingest all HARs that have not been ingested yet, also by other processes."""
+        self.hars.refresh()
+        missing = [k for k in keys if k not in self.hars]
+
+        def ingest(key: str) -> tuple[str, DedupStats]:
+            with profiling.span("ingest", key=key):
+                har, stats = self.ingest(json.loads(get_from_s3(key)))
+                self.hars.put(key, json.dumps(har), if_absent=True)
+            return key, stats
+
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
+            for key, stats in executor.map(ingest, missing):
+                results[key] = stats
+                print(".", end="", flush=True)
+        if missing:
+            print("")
+        return results
+
+    def keyword_counts(self, keys: Iterable[str], memo: Memo, per_site: bool = False) -> pd.DataFrame:
+        """
+        Keyword pattern hits per run (or per site, i.e. per {run_id}/{part-i}). Every unique body is scanned
+        only once (ever), the per-body counts are then multiplied out over all entries referencing it.
+        """
+        from admeasure_py.fast_re import count_matches, search_terms
+
+        refs: dict[str, list[str]] = {}
+        for key in keys:
+            refs[key] = [
+                entry["response"]["content"]["_blob"]
+                for entry in self.har(key)["log"]["entries"]
+                if "_blob" in entry["response"]["content"]
+            ]
+        unique = {digest: digest for digests in refs.values() for digest in digests}
+        # content-addressed, so the digest and the patterns (keywords.json) are a perfect cache key
+        counts = memo.stage("har.keywords").map(
+            unique, lambda digest, _: count_matches(self.blobs[digest]), lambda *_: search_terms)
+
+        rows = {}
+        for key, digests in refs.items():
+            row = rows.setdefault(key.rpartition("/")[0] if per_site else run_id(key), {})
+            for digest in digests:
+                for pattern, n in counts[digest].items():
+                    row[pattern] = row.get(pattern, 0) + n
+        return pd.DataFrame.from_dict(rows, orient="index").fillna(0).astype(int).sort_index().rename_axis("id")
+
+    def close(self) -> None:
+        self.blobs.close()
+        self.hars.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def dedup_summary(stats: dict[str, DedupStats]) -> pd.DataFrame:
+    """Per-run deduplication statistics."""
+    df = pd.DataFrame.from_dict(stats, orient="index")
+    df = df.groupby(df.index.map(run_id)).sum()
+    df["dedup_ratio"] = 1 - df.new_body_bytes / df.body_bytes.where(df.body_bytes > 0)
+    return df.sort_index()
@@ -0,0 +1,157 @@
+"""
+Sharded, concurrent bulk operations on the bucket.
+
+Deleting a prefix is split into one shard per sub-prefix (as listed by `enumerate_bucket`),
+shards are listed in parallel and the resulting DeleteObjects batches run concurrently.
+Uploads use a tuned multipart configuration and run concurrently across files.
+"""
+import concurrent.futures
+import sys
+import time
+from collections.abc import Generator, Iterable
+from pathlib import Path
+from typing import Optional
+
+from boto3.s3.transfer import TransferConfig
+from mypy_boto3_s3 import Client
+
+from admeasure_py.utils import enumerate_bucket, s3_bucket
+
+# hard limit of the DeleteObjects API
+DELETE_BATCH_SIZE = 1000
+
+UPLOAD_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 ** 2,
+    multipart_chunksize=8 * 1024 ** 2,
+    max_concurrency=16,
+    use_threads=True,
+)
+
+
+class BulkStats:
+    objects: int
+    bytes: int
+    errors: int
+    start: float
+
+    def __init__(self):
+        self.objects = 0
+        self.bytes = 0
+        self.errors = 0
+        self.start = time.time()
+
+    @property
+    def elapsed(self) -> float:
+        return time.time() - self.start
+
+    def __str__(self):
+        elapsed = max(self.elapsed, 1e-9)
+        s = f"{self.objects} objects in {elapsed:.1f}s ({self.objects / elapsed:.1f} objects/s"
+        if self.bytes:
+            s += f", {self.bytes / 1024 ** 2 / elapsed:.1f} MB/s"
+        s += ")"
+        if self.errors:
+            s += f", {self.errors} errors"
+        return s
+
+
+def list_keys(client: Client, bucket: str, prefix: str, delimiter: str = "") -> Generator[tuple[str, int]]:
+    """
+    Yield (key, size) for all objects under prefix.
+    With a delimiter, only objects directly under prefix are returned.
+    """
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter=delimiter):
+        for obj in page.get("Contents", []):
+            yield obj["Key"], obj["Size"]
+
+
+def shard_prefix(prefix: str, delimiter: str = "/") -> list[tuple[str, str]]:
+    """
+    Split prefix into independently listable (prefix, delimiter) shards:
+    one for the objects directly under prefix and one for each sub-prefix.
+    """
+    return [(prefix, delimiter)] + [
+        (sub, "")
+        for sub in enumerate_bucket(prefix, delimiter)
+    ]
+
+
+def _batches(keys: Iterable[tuple[str, int]], n: int) -> Generator[list[tuple[str, int]]]:
+    batch = []
+    for k in keys:
+        batch.append(k)
+        if len(batch) == n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def delete_prefix(prefix: str, workers: int = 16, dry_run: bool = False) -> BulkStats:
+    bucket = s3_bucket()
+    client: Client = bucket.meta.client  # type: ignore
+    shards = shard_prefix(prefix)
+    stats = BulkStats()
+
+    def delete_batch(batch: list[tuple[str, int]]) -> tuple[int, int, int]:
+        size = sum(s for _, s in batch)
+        if dry_run:
+            return len(batch), size, 0
+        resp = client.delete_objects(
+            Bucket=bucket.name,
+            Delete={"Objects": [{"Key": k} for k, _ in batch], "Quiet": True},
+        )
+        errors = len(resp.get("Errors", []))
+        return len(batch) - errors, size, errors
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as listers, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=workers) as deleters:
+        def list_shard(shard: tuple[str, str]) -> list[concurrent.futures.Future]:
+            return [
+                deleters.submit(delete_batch, batch)
+                for batch in _batches(list_keys(client, bucket.name, *shard), DELETE_BATCH_SIZE)
+            ]
+
+        batches = [
+            batch
+            for shard in concurrent.futures.as_completed([listers.submit(list_shard, s) for s in shards])
+            for batch in shard.result()
+        ]
+        for f in concurrent.futures.as_completed(batches):
+            deleted, size, errors = f.result()
+            stats.objects += deleted
+            stats.bytes += size
+            stats.errors += errors
+            print("." if not errors else "x", end="")
+            sys.stdout.flush()
+    if batches:
+        print("")
+    print(f"{len(shards)} shards, {'would delete' if dry_run else 'deleted'} {stats}")
+    return stats
+
+
+def upload_files(
+    filenames: Iterable[str],
+    key_prefix: str = "resources/",
+    extra_args: Optional[dict] = None,
+    workers: int = 4,
+    dry_run: bool = False,
+) -> BulkStats:
+    bucket = s3_bucket()
+    stats = BulkStats()
+
+    def upload(f: str) -> int:
+        size = Path(f).stat().st_size
+        if not dry_run:
+            bucket.upload_file(f, f"{key_prefix}{f}", ExtraArgs=extra_args, Config=UPLOAD_CONFIG)
+        return size
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(upload, f): f for f in filenames}
+        for future in concurrent.futures.as_completed(futures):
+            stats.objects += 1
+            stats.bytes += future.result()
+            print(f"{key_prefix}{futures[future]}")
+    print(f"{'would upload' if dry_run else 'uploaded'} {stats}")
+    return stats
@@ -3,6 +3,7 @@ import re
 import warnings
 import threading
 
+from admeasure_py import profiling
 from admeasure_py.utils import keywords, timeit
 
 search_terms: list[str] = [
@@ -18,6 +19,7 @@ search_terms_rex: re.Pattern[bytes] = re.compile(
 
 
 def _count_matches_re(x: bytes) -> dict[str, int]:
+    profiling.count("regex.bytes_scanned", len(x))
     matches: dict[str, int] = {
         t: 0
         for t in search_terms
@@ -46,6 +48,7 @@ try:
 
 
     def _count_matches_hyperscan(data):
+        profiling.count("regex.bytes_scanned", len(data))
         matches: dict[str, int] = {
             t: 0
             for t in search_terms
@@ -0,0 +1,197 @@
+"""
+Local SQLite index of measurement plans: plan id → region, device, strategies and the URL list of each part.
+
+Plans are immutable once uploaded, so each plan.json is only fetched once and the index grows incrementally.
+"""
+import concurrent.futures
+import os
+import sqlite3
+from functools import cache
+from pathlib import Path
+from typing import Optional, Union
+
+import pandas as pd
+from botocore.exceptions import ClientError
+from mypy_boto3_s3.service_resource import ObjectSummary
+
+from admeasure_py.utils import MeasurementPlanV3, get_from_s3, json, list_objects
+
+PARTS = ["prime", "measure"]
+
+# language="SQL"
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS plans (
+    id TEXT PRIMARY KEY,
+    region TEXT,
+    device TEXT,
+    device_profile TEXT,
+    prime_strategy TEXT,
+    measure_strategy TEXT,
+    plan BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS parts (
+    plan_id TEXT NOT NULL,
+    part TEXT NOT NULL,
+    PRIMARY KEY (plan_id, part)
+);
+CREATE TABLE IF NOT EXISTS urls (
+    plan_id TEXT NOT NULL,
+    part TEXT NOT NULL,
+    i INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    PRIMARY KEY (plan_id, part, i)
+);
+"""
+
+
+def index_path() -> Path:
+    if p := os.environ.get("ADMEASURE_INDEX"):
+        return Path(p)
+    return Path.home() / ".cache" / "admeasure" / "index.sqlite"
+
+
+@cache
+def connect() -> sqlite3.Connection:
+    path = index_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def known_plans() -> set[str]:
+    return {id for id, in connect().execute("SELECT id FROM plans")}
+
+
+def plans_without_urls() -> set[str]:
+    """plans indexed without any of their URLs, e.g. sampled plans indexed with urls=False"""
+    return {id for id, in connect().execute("SELECT id FROM plans WHERE id NOT IN (SELECT plan_id FROM parts)")}
+
+
+def add_plan(plan: MeasurementPlanV3) -> None:
+    device = plan.get("device") or {}
+    conn = connect()
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO plans VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                plan["id"],
+                plan.get("region"),
+                device.get("type"),
+                device.get("profile"),
+                plan["prime"]["strategy"],
+                plan["measure"]["strategy"],
+                json.dumps(plan),
+            )
+        )
+    for part in PARTS:
+        # sampled plans only specify a collection, the actual URLs are in {part}.json.
+        if isinstance(plan[part]["urls"], list):
+            add_urls(plan["id"], part, plan[part]["urls"])
+
+
+def add_urls(plan_id: str, part: str, urls: list[str]) -> None:
+    conn = connect()
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO parts VALUES (?, ?)", (plan_id, part))
+        conn.executemany(
+            "INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?)",
+            [(plan_id, part, i, url) for i, url in enumerate(urls)]
+        )
+
+
+def _get_if_exists(key: str) -> Optional[bytes]:
+    """None if the object does not exist. Other errors (throttling, access) are raised, they must not be indexed."""
+    try:
+        return get_from_s3(key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return None
+        raise
+
+
+def _fetch_part_urls(plan_id: str, part: str) -> Optional[list[str]]:
+    part_data = _get_if_exists(f"{plan_id}/{part}.json")
+    if part_data is None:
+        return None
+    return json.loads(part_data)["urls"]
+
+
+def index_plans(plan_files: list[Union[str, ObjectSummary]], urls: bool = True) -> int:
+    """
+    Add all plan.json files that are not yet indexed.
+    With urls=True, {part}.json is fetched for sampled plans to record their URLs as well,
+    also for known plans that were indexed without URLs.
+    """
+    known = known_plans()
+    if urls:
+        known -= plans_without_urls()
+    keys = [getattr(f, "key", f) for f in plan_files]
+    missing = [k for k in keys if k.rpartition("/")[0] not in known]
+    if not missing:
+        return 0
+
+    def fetch(key: str) -> tuple[MeasurementPlanV3, dict[str, list[str]]]:
+        plan = json.loads(get_from_s3(key))
+        part_urls = {}
+        if urls:
+            for part in PARTS:
+                if not isinstance(plan[part]["urls"], list):
+                    if (u := _fetch_part_urls(plan["id"], part)) is not None:
+                        part_urls[part] = u
+        return plan, part_urls
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
+        for plan, part_urls in executor.map(fetch, missing):
+            add_plan(plan)
+            for part, u in part_urls.items():
+                add_urls(plan["id"], part, u)
+    print(f"Indexed {len(missing)} plans ({len(keys) - len(missing)} already known).")
+    return len(missing)
+
+
+def update_index(prefix: str, urls: bool = True) -> int:
+    plan_files = [
+        file.key
+        for file in list_objects(prefix)
+        if file.key.endswith("plan.json")
+    ]
+    return index_plans(plan_files, urls)
+
+
+def _indexed(plan_id: str, part: str) -> bool:
+    n, = connect().execute("SELECT COUNT(*) FROM parts WHERE plan_id = ? AND part = ?", (plan_id, part)).fetchone()
+    return n > 0
+
+
+def lookup_url(plan_id: str, part: str, i: int) -> str:
+    """
+    Look up a visited URL, fetching and indexing the plan on a miss.
+    Raises LookupError if the plan has no such part and IndexError if the part has no such URL.
+    """
+    conn = connect()
+    if not _indexed(plan_id, part):
+        if plan_id not in known_plans():
+            if (plan_data := _get_if_exists(f"{plan_id}/plan.json")) is not None:
+                add_plan(json.loads(plan_data))
+        # the plan may have listed the URLs itself
+        if not _indexed(plan_id, part):
+            if (urls := _fetch_part_urls(plan_id, part)) is None:
+                raise LookupError(f"{plan_id} has neither a plan.json with {part} URLs nor a {part}.json.")
+            add_urls(plan_id, part, urls)
+    row = conn.execute("SELECT url FROM urls WHERE plan_id = ? AND part = ? AND i = ?", (plan_id, part, i)).fetchone()
+    if row is None:
+        raise IndexError(f"{plan_id}/{part} has no URL #{i}.")
+    return row[0]
+
+
+def plan_attributes(plan_ids: Optional[list[str]] = None) -> pd.DataFrame:
+    """Flat plan attributes indexed by plan id, suitable for joining with per-site frames."""
+    df = pd.read_sql_query(
+        "SELECT id, region, device, device_profile, prime_strategy, measure_strategy FROM plans",
+        connect(),
+        index_col="id",
+    )
+    if plan_ids is not None:
+        df = df[df.index.isin(plan_ids)]
+    return df
@@ -0,0 +1,359 @@
+"""
+Map-reduce over run prefixes: `adm mapreduce run ANALYSIS PREFIX` splits the runs below a prefix into shards,
+workers compute a partial aggregate per shard and a reduce step sums them up.
+
+Partials are count tables (table → row → column → count) stored as JSON in an exchange,
+a local directory or an S3 prefix (s3://mapreduce/...) that remote analysis VMs can share:
+
+    <exchange>/<job>/manifest.json          analysis, prefix and the run prefixes of each shard
+    <exchange>/<job>/partial-00003.json     the partial of shard 3
+
+All aggregates are plain sums, so the merged result is independent of how runs are sharded
+and equal to a single-node run (one shard).
+"""
+import collections
+import datetime
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any
+
+import click
+import pandas as pd
+
+from admeasure_py.utils import analysis, cache_backend, enumerate_bucket, get_from_s3, get_resource_url, json, \
+    list_objects, run, s3_bucket, sanitize_hostname
+
+here = Path(__file__).parent
+
+default_exchange = Path.home() / ".cache" / "admeasure" / "mapreduce"
+
+Table = dict[str, dict[str, int]]
+Partial = dict[str, Table]
+
+# rows of multi-column tables are tab-separated keys
+SEP = "\t"
+
+
+class Exchange:
+    """Where manifests and partials are exchanged between coordinator and workers."""
+    url: str
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+
+    @property
+    def is_s3(self) -> bool:
+        return self.url.startswith("s3://")
+
+    def _key(self, name: str) -> str:
+        return f"{self.url.removeprefix('s3://')}/{name}"
+
+    def put(self, name: str, data: bytes) -> None:
+        if self.is_s3:
+            s3_bucket().put_object(Key=self._key(name), Body=data)
+        else:
+            f = Path(self.url) / name
+            f.parent.mkdir(parents=True, exist_ok=True)
+            tmp = f.with_name(f"{f.name}.tmp")
+            tmp.write_bytes(data)
+            tmp.replace(f)
+
+    def get(self, name: str) -> bytes:
+        if self.is_s3:
+            return get_from_s3(self._key(name))
+        return (Path(self.url) / name).read_bytes()
+
+    def names(self, prefix: str) -> set[str]:
+        if self.is_s3:
+            base = self._key("")
+            return {o.key.removeprefix(base) for o in list_objects(self._key(prefix))}
+        return {str(f.relative_to(self.url).as_posix()) for f in (Path(self.url) / prefix).rglob("*") if f.is_file()}
+
+
+def _count(table: Table, row: str, column: str, n: int = 1) -> None:
+    r = table.setdefault(row, {})
+    r[column] = r.get(column, 0) + n
+
+
+def map_keywords(prefixes: list[str], download_workers: int, workers: int) -> Partial:
+    """Keyword pattern hits per run in HAR response bodies (see `adm har keywords`)."""
+    from admeasure_py.blobs import HarStore, store_path
+    from admeasure_py.stages import Memo
+
+    table: Table = {}
+    with HarStore(store_path()) as store:
+        memo = Memo(store.directory / "stages.sqlite")
+        for prefix in prefixes:
+            keys = sorted(o.key for o in list_objects(prefix) if o.key.endswith("/requests.har"))
+            store.ingest_from_s3(keys)
+            for run_id, row in store.keyword_counts(keys, memo).iterrows():
+                for pattern, n in row.items():
+                    _count(table, run_id, pattern, int(n))
+    return {"keywords": table}
+
+
+def map_consent_test(prefixes: list[str], download_workers: int, workers: int) -> Partial:
+    """Outcome counts per CMP, location, device and strategy."""
+    from admeasure_py.index import index_plans, plan_attributes
+    from admeasure_py.stages import Memo
+
+    ct = analysis("consent-test")
+    memo = Memo(ct["here"] / "stages.sqlite")
+    table: Table = {}
+    with cache_backend(ct["cache_dir"]) as cache:
+        for prefix in prefixes:
+            consent_files, records, plan_files = ct["stream_records"](prefix, cache, memo, download_workers, workers)
+            if not consent_files:
+                continue
+            index_plans(plan_files, urls=False)
+            df = ct["results"](consent_files, plan_attributes(), memo, records)
+            for (*row, outcome), n in df.groupby(
+                    ["cmp", "location", "device", "strategy", "outcome"], dropna=False).size().items():
+                _count(table, SEP.join(map(str, row)), outcome, int(n))
+    return {"outcomes": table}
+
+
+def map_log(prefixes: list[str], download_workers: int, workers: int) -> Partial:
+    """Log files, entries, errors and global timeouts per run."""
+    from admeasure_py.pipeline import fetch
+
+    log = analysis("log")
+
+    def stats(x) -> tuple[str, dict[str, int]]:
+        id, f = x
+        job = log["is_job_file"](id)
+        entries = log["file_log_entries"](id, f, job)
+        run_id = id.rpartition("/")[0] if job else id.rpartition("/")[0].rpartition("/")[0]
+        return run_id, {
+            "files": 1,
+            "entries": len(entries),
+            "errors": sum("error" in e["text"].lower() for e in entries),
+            "timeouts": sum("Global timeout" in e["text"] for e in entries),
+        }
+
+    table: Table = {}
+    with cache_backend(log["cache_dir"]) as cache:
+        for prefix in prefixes:
+            for run_id, row in fetch(cache, log["log_objects"](prefix), download_workers).map(stats, workers):
+                for column, n in row.items():
+                    _count(table, run_id, column, n)
+    return {"log": table}
+
+
+MAPPERS: dict[str, Callable[[list[str], int, int], Partial]] = {
+    "keywords": map_keywords,
+    "consent-test": map_consent_test,
+    "log": map_log,
+}
+
+
+def merge(partials: list[Partial]) -> Partial:
+    merged: Partial = {}
+    for partial in partials:
+        for name, table in partial.items():
+            t = merged.setdefault(name, {})
+            for row, columns in table.items():
+                for column, n in columns.items():
+                    _count(t, row, column, n)
+    return merged
+
+
+def to_frames(partial: Partial) -> dict[str, pd.DataFrame]:
+    """One frame per table, rows and columns sorted. Tab-separated row keys become a MultiIndex."""
+    frames = {}
+    for name, table in partial.items():
+        df = pd.DataFrame.from_dict(table, orient="index").fillna(0).astype(int)
+        if len(df) and all(SEP in r for r in df.index):
+            df.index = pd.MultiIndex.from_tuples([tuple(r.split(SEP)) for r in df.index])
+        frames[name] = df.sort_index().sort_index(axis=1)
+    if "outcomes" in frames:
+        o = frames["outcomes"]
+        if o.empty:
+            # no consent files, or none with one of the analyzed CMPs
+            return frames
+        o.index.names = ["cmp", "location", "device", "strategy"]
+        # same as consent-test's outcome_distribution
+        counts = o.groupby(level=["cmp", "strategy"]).sum()
+        counts.columns.name = "outcome"
+        frames["outcome_distribution"] = counts.div(counts.sum(axis=1), axis=0)
+    return frames
+
+
+def is_run(prefix: str) -> bool:
+    return any(True for _ in list_objects(f"{prefix}plan.json"))
+
+
+def shards(prefix: str, n: int) -> list[list[str]]:
+    """
+    Split the run prefixes below prefix into n shards (round-robin over the sorted prefixes).
+    Runs are never split, their plan.json belongs to all of their pages.
+    """
+    directory = f"{prefix.rstrip('/')}/"
+    if is_run(directory):
+        prefixes = [directory]
+    else:
+        prefixes = sorted(enumerate_bucket(prefix, "/"))
+        if prefixes == [directory]:
+            # prefix is a directory of runs, shard by its children
+            prefixes = sorted(enumerate_bucket(directory, "/")) or prefixes
+    prefixes = prefixes or [prefix]
+    return [prefixes[i::n] for i in range(min(n, len(prefixes)))]
+
+
+def _partial_name(job: str, shard: int) -> str:
+    return f"{job}/partial-{shard:05d}.json"
+
+
+def plan_job(exchange: Exchange, job: str, name: str, prefix: str, n: int) -> dict[str, Any]:
+    manifest = {
+        "job": job,
+        "analysis": name,
+        "prefix": prefix,
+        "shards": shards(prefix, n),
+    }
+    exchange.put(f"{job}/manifest.json", json.dumps(manifest, option=json.OPT_INDENT_2))
+    return manifest
+
+
+def work(exchange: Exchange, job: str, shard: int, download_workers: int = 10, workers: int = 4) -> Partial:
+    """Compute and store the partial of one shard."""
+    manifest = json.loads(exchange.get(f"{job}/manifest.json"))
+    start = time.time()
+    partial = MAPPERS[manifest["analysis"]](manifest["shards"][shard], download_workers, workers)
+    exchange.put(_partial_name(job, shard), json.dumps(partial))
+    print(f"{job}: shard {shard} done after {time.time() - start:.0f}s")
+    return partial
+
+
+def reduce(exchange: Exchange, job: str) -> Partial:
+    manifest = json.loads(exchange.get(f"{job}/manifest.json"))
+    names = exchange.names(f"{job}/")
+    expected = [_partial_name(job, i) for i in range(len(manifest["shards"]))]
+    if missing := [i for i, name in enumerate(expected) if name not in names]:
+        raise RuntimeError(f"{job}: {len(missing)} of {len(expected)} partials missing (shards {missing}).")
+    return merge([json.loads(exchange.get(name)) for name in expected])
+
+
+def run_local(exchange: Exchange, job: str, n_shards: int, processes: int, download_workers: int, workers: int) -> None:
+    """
+    Run all shards in local worker processes. Each process handles every processes-th shard.
+    All workers share the HAR store (see HarStore.put_blob), analysis caches use the file-per-object backend.
+    """
+    procs = []
+    for w in range(min(processes, n_shards)):
+        env = {**os.environ, "ADMEASURE_CACHE_BACKEND": "files"}
+        cmd = [sys.executable, "-m", "admeasure_py", "mapreduce", "work", exchange.url, job,
+               *map(str, range(w, n_shards, processes)),
+               "--download-workers", str(download_workers), "--workers", str(workers)]
+        procs.append(subprocess.Popen(cmd, env=env))
+    if failed := [p.args for p in procs if p.wait() != 0]:
+        raise RuntimeError(f"{len(failed)} workers failed.")
+
+
+def analysis_worker_cloudconfig(exchange: Exchange, job: str, shard: int) -> str:
+    """
+    Install the current wheel, compute the shard and destroy the VM, also if anything fails on the way.
+    Failures are reported to the coordinator with a failed-marker (see mark_failed).
+    """
+    adm = "/root/venv/bin/adm"
+    args = f"{shlex.quote(exchange.url)} {shlex.quote(job)} {shard}"
+    wheel = "admeasure-0.0.0-py3-none-any.whl"
+    # language="Shell Script"
+    return textwrap.dedent(f"""
+    #!/usr/bin/bash
+    set -e
+    set -o pipefail
+    set -x
+
+    on_exit() {{
+      status=$?
+      if [ $status -ne 0 ]; then
+        {adm} mapreduce fail {args} --log /root/mapreduce.log || echo "could not report the failure"
+      fi
+      self-destroy
+    }}
+    trap on_exit EXIT
+
+    cd /root
+    curl -f {get_resource_url(wheel)} -o /root/{wheel}
+    /root/venv/bin/pip install --force-reinstall /root/{wheel} --no-deps
+    {adm} mapreduce work {args} 2>&1 | tee /root/mapreduce.log
+    """).strip()
+
+
+def spawn_analysis_worker(exchange: Exchange, job: str, shard: int, region: str = "eu-central-1",
+                          bundle: str = "large_2_0") -> str:
+    """Start an analysis VM (admeasure-analysis snapshot) that computes one shard and destroys itself."""
+    if not exchange.is_s3:
+        raise ValueError("Remote workers need an s3:// exchange.")
+    # next to the package like spawn_runner, so that file:// stays reachable from WSL bash
+    with tempfile.TemporaryDirectory(dir=here) as tmpdir:
+        cloudinit = Path(tmpdir) / "cloudinit.yaml"
+        cloudinit.write_text(analysis_worker_cloudconfig(exchange, job, shard), "utf8")
+        # language="Shell Script"
+        return run(f"""
+        aws lightsail create-instances-from-snapshot \
+          --profile admeasure \
+          --instance-snapshot-name admeasure-analysis \
+          --region {region} --availability-zone {region}a \
+          --bundle-id {bundle} \
+          --user-data file://{cloudinit} \
+          --tags key=analysis \
+          --instance-names a-{sanitize_hostname(f"{job}-{shard}")}
+        """)
+
+
+def _failed_name(job: str, shard: int) -> str:
+    return f"{job}/failed-{shard:05d}"
+
+
+def mark_failed(exchange: Exchange, job: str, shard: int, log: str = "") -> None:
+    """Tell the coordinator that a shard failed, so that it does not wait for it until the timeout."""
+    exchange.put(_failed_name(job, shard), log.encode())
+
+
+def wait_for_partials(exchange: Exchange, job: str, n_shards: int, timeout: float, interval: float = 30) -> None:
+    start = time.time()
+    while True:
+        names = exchange.names(f"{job}/")
+        if failed := sorted(name for name in names if name.startswith(f"{job}/failed-")):
+            for name in failed:
+                click.secho(f"# {name}", fg="red")
+                print(exchange.get(name).decode(errors="replace"))
+            raise RuntimeError(f"{job}: {len(failed)} shards failed.")
+        done = sum(name.startswith(f"{job}/partial-") for name in names)
+        print(f"[{datetime.datetime.utcnow().isoformat(timespec='seconds')}] {done}/{n_shards} shards done.")
+        if done >= n_shards:
+            return
+        if time.time() > start + timeout:
+            raise TimeoutError(f"{job}: only {done} of {n_shards} shards done after {timeout:.0f}s.")
+        time.sleep(interval)
+
+
+def summarize(frames: dict[str, pd.DataFrame]) -> None:
+    with pd.option_context("display.max_rows", 100, "display.width", None):
+        for name, df in frames.items():
+            print(f"# {name}")
+            print(df)
+
+
+def counts_equal(a: Partial, b: Partial) -> bool:
+    """Whether two partials are equal, ignoring zero counts."""
+
+    def nonzero(p: Partial) -> dict[tuple[str, str, str], int]:
+        return collections.Counter({
+            (name, row, column): n
+            for name, table in p.items()
+            for row, columns in table.items()
+            for column, n in columns.items()
+            if n
+        })
+
+    return nonzero(a) == nonzero(b)
@@ -0,0 +1,244 @@
+"""
+Packed cache backend: objects are appended (gzip-compressed) to a few large segment files
+and located through an append-only offset index, instead of one decompressed file per S3 object.
+
+    <directory>/index            one line per object: key \t segment \t offset \t length
+    <directory>/segment-00000    concatenated gzip members (or zstd frames, see zdict)
+
+Segments are read through mmap. A store may be shared by many threads and processes: writers append under an
+exclusive lock on <directory>/lock (flock, msvcrt.locking on Windows),
+objects written by other processes become visible on refresh() (put(if_absent=True) refreshes under the lock).
+"""
+import contextlib
+import gzip
+import mmap
+import os
+import threading
+from collections.abc import Iterator
+from pathlib import Path
+
+from admeasure_py import profiling, zdict
+
+SEGMENT_SIZE = 512 * 1024 ** 2
+
+
+class PackedFile:
+    """Path-like handle to an object in a PackedStore, so callers can keep using .read_bytes()."""
+    store: "PackedStore"
+    key: str
+
+    def __init__(self, store: "PackedStore", key: str):
+        self.store = store
+        self.key = key
+
+    @property
+    def name(self) -> str:
+        return self.key.rpartition("/")[2]
+
+    def exists(self) -> bool:
+        return self.key in self.store
+
+    def read_bytes(self) -> bytes:
+        return self.store[self.key]
+
+    def size(self) -> int:
+        """compressed size"""
+        return self.store.size(self.key)
+
+    def read_compressed(self) -> bytes:
+        return self.store.get_compressed(self.key)
+
+    def __fspath__(self):
+        raise TypeError(f"{self!r} is not backed by a file.")
+
+    def __repr__(self):
+        return f"PackedFile({str(self.store.directory)!r}, {self.key!r})"
+
+
+class PackedStore:
+    directory: Path
+    segment_size: int
+    _index: dict[str, tuple[int, int, int]]
+    _maps: dict[int, mmap.mmap]
+
+    def __init__(self, directory: Path, segment_size: int = SEGMENT_SIZE):
+        self.directory = Path(directory)
+        self.segment_size = segment_size
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._maps = {}
+        self._index = {}
+        self._lock_file = (self.directory / "lock").open("a")
+        with self._write_lock():
+            self._load()
+
+    def _load(self) -> None:
+        index = self.directory / "index"
+        self._index_pos = 0
+        torn = self._read_index()
+        self._segment = max((s for s, _, _ in self._index.values()), default=0)
+        self._index_file = index.open("a", encoding="utf8", newline="\n")
+        if torn:
+            self._index_file.write("\n")
+            self._index_file.flush()
+        self._segment_file = self._segment_path(self._segment).open("ab")
+
+    def _read_index(self) -> bool:
+        """Add the index lines appended since the last read, by any process. Returns whether the last line is torn."""
+        index = self.directory / "index"
+        if not index.exists():
+            return False
+        with index.open("rb") as f:
+            f.seek(self._index_pos)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].decode("utf8").splitlines():
+            try:
+                key, segment, offset, length = line.split("\t")
+                self._index[key] = (int(segment), int(offset), int(length))
+            except ValueError:
+                # torn write of a crashed writer, the object will be downloaded again.
+                pass
+        self._index_pos += end
+        return end < len(data)
+
+    def refresh(self) -> None:
+        """Pick up the objects other processes added since the store was opened."""
+        with self._lock:
+            self._read_index()
+
+    def _segment_path(self, segment: int) -> Path:
+        return self.directory / f"segment-{segment:05d}"
+
+    @contextlib.contextmanager
+    def _write_lock(self):
+        """Exclusive across processes, so that concurrent writers never overlap in a segment or the index."""
+        fd = self._lock_file.fileno()
+        if os.name == "nt":
+            import msvcrt
+
+            # locks the first byte of the lock file, LK_LOCK gives up after 10 attempts
+            os.lseek(fd, 0, os.SEEK_SET)
+            while True:
+                try:
+                    msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+            try:
+                yield
+            finally:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _next_segment(self) -> None:
+        self._segment_file.close()
+        self._segment += 1
+        self._segment_file = self._segment_path(self._segment).open("ab")
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self._index))
+
+    def keys(self) -> list[str]:
+        return list(self._index)
+
+    def file(self, key: str) -> PackedFile:
+        return PackedFile(self, key)
+
+    def size(self, key: str) -> int:
+        return self._index[key][2]
+
+    def put(self, key: str, data: bytes, compressed: bool = False, if_absent: bool = False) -> bool:
+        """
+        Append an object. Pass already gzip/zstd-compressed data (e.g. an S3 body) with compressed=True.
+        With if_absent=True, keys that any process already stored are skipped. Returns whether data was written.
+        """
+        if not compressed:
+            data = gzip.compress(data, compresslevel=6)
+        with self._lock, self._write_lock():
+            if if_absent:
+                self._read_index()
+                if key in self._index:
+                    return False
+            # another process may have started a new segment or appended to ours since we last wrote.
+            while self._segment_path(self._segment + 1).exists():
+                self._next_segment()
+            offset = os.fstat(self._segment_file.fileno()).st_size
+            if offset + len(data) > self.segment_size and offset > 0:
+                self._next_segment()
+                offset = os.fstat(self._segment_file.fileno()).st_size
+            self._segment_file.write(data)
+            self._segment_file.flush()
+            # only index data that is on disk, so that a crash never leaves dangling entries.
+            self._index_file.write(f"{key}\t{self._segment}\t{offset}\t{len(data)}\n")
+            self._index_file.flush()
+            self._index[key] = (self._segment, offset, len(data))
+        return True
+
+    def _map(self, segment: int, end: int) -> mmap.mmap:
+        m = self._maps.get(segment)
+        if m is None or len(m) < end:
+            with self._lock:
+                m = self._maps.get(segment)
+                if m is None or len(m) < end:
+                    # the segment grew since we mapped it
+                    with self._segment_path(segment).open("rb") as f:
+                        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._maps[segment] = m
+        return m
+
+    def get_compressed(self, key: str) -> bytes:
+        segment, offset, length = self._index[key]
+        return self._map(segment, offset + length)[offset:offset + length]
+
+    def __getitem__(self, key: str) -> bytes:
+        data = zdict.decode(self.get_compressed(key))
+        profiling.count("cache.packed_bytes_read", len(data))
+        return data
+
+    def close(self) -> None:
+        with self._lock:
+            self._segment_file.close()
+            self._index_file.close()
+            self._lock_file.close()
+            for m in self._maps.values():
+                m.close()
+            self._maps.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def pack_directory(directory: Path, store: PackedStore) -> int:
+    """Copy an existing file-per-object cache directory into a packed store."""
+    from admeasure_py.utils import normalize_id
+
+    added = 0
+    for f in sorted(directory.rglob("*")):
+        if not f.is_file():
+            continue
+        rel = f.relative_to(directory)
+        key = f"{normalize_id(str(rel.parent))}/{rel.name}"
+        if key not in store:
+            data = f.read_bytes()
+            # files may already be compressed (see adm zdict recompress)
+            store.put(key, data, compressed=data[:2] == zdict.GZIP_MAGIC or data[:4] == zdict.ZSTD_MAGIC)
+            added += 1
+    return added
@@ -0,0 +1,156 @@
+"""
+Streaming pipeline: list → download → decode/parse → analyze, with all stages running concurrently.
+
+Stages are connected by bounded queues, so a slow stage applies backpressure to the ones before it
+instead of buffering the whole prefix in memory. Each stage has its own number of worker threads.
+Results are yielded in completion order.
+
+    for id, record in fetch(cache_dir, list_objects(prefix), workers=10).map(analyze, workers=4):
+        ...
+"""
+import queue
+import threading
+from collections.abc import Callable, Iterable, Iterator
+from pathlib import Path
+from typing import Any, Optional, Union
+
+import click
+from mypy_boto3_s3.service_resource import Object, ObjectSummary
+
+from admeasure_py import profiling
+from admeasure_py.packed import PackedFile, PackedStore
+from admeasure_py.utils import download_file
+
+QUEUE_SIZE = 256
+
+_DONE = object()
+
+
+class _Failed:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class _Stage:
+    def __init__(self, name: str, fn: Callable[[Any], Any], workers: int):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+
+
+class Pipeline:
+    source: Iterable[Any]
+    queue_size: int
+
+    def __init__(self, source: Iterable[Any], queue_size: int = QUEUE_SIZE):
+        self.source = source
+        self.queue_size = queue_size
+        self._stages: list[_Stage] = []
+
+    def map(self, fn: Callable[[Any], Any], workers: int = 1, name: Optional[str] = None) -> "Pipeline":
+        """Add a stage applying fn to every item. Items for which fn returns None are dropped."""
+        if workers < 1:
+            raise ValueError(f"a stage needs at least one worker, got {workers}.")
+        self._stages.append(_Stage(name or getattr(fn, "__name__", "stage"), fn, workers))
+        return self
+
+    def filter(self, predicate: Callable[[Any], bool], name: str = "filter") -> "Pipeline":
+        return self.map(lambda x: x if predicate(x) else None, name=name)
+
+    def __iter__(self) -> Iterator[Any]:
+        stop = threading.Event()
+        queues = [queue.Queue(self.queue_size) for _ in range(len(self._stages) + 1)]
+
+        def put(q: queue.Queue, item: Any) -> bool:
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get(q: queue.Queue) -> Any:
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return _DONE
+
+        def produce():
+            try:
+                with profiling.span("pipeline.source"):
+                    for item in self.source:
+                        if not put(queues[0], item):
+                            return
+            except BaseException as e:
+                put(queues[-1], _Failed(e))
+            put(queues[0], _DONE)
+
+        def work(stage: _Stage, inbox: queue.Queue, outbox: queue.Queue, remaining: list[int], lock: threading.Lock):
+            while True:
+                item = get(inbox)
+                if item is _DONE:
+                    # let the other workers of this stage see it, the last one passes it on.
+                    put(inbox, _DONE)
+                    with lock:
+                        remaining[0] -= 1
+                        last = remaining[0] == 0
+                    if last:
+                        put(outbox, _DONE)
+                    return
+                try:
+                    with profiling.span(stage.name):
+                        result = stage.fn(item)
+                except BaseException as e:
+                    put(queues[-1], _Failed(e))
+                    return
+                if result is not None:
+                    put(outbox, result)
+
+        threads = [threading.Thread(target=produce, daemon=True)]
+        for i, stage in enumerate(self._stages):
+            remaining = [stage.workers]
+            lock = threading.Lock()
+            threads.extend(
+                threading.Thread(target=work, args=(stage, queues[i], queues[i + 1], remaining, lock), daemon=True)
+                for _ in range(stage.workers)
+            )
+        for t in threads:
+            t.start()
+
+        try:
+            while True:
+                item = queues[-1].get()
+                if item is _DONE:
+                    break
+                if isinstance(item, _Failed):
+                    raise item.error
+                profiling.observe("pipeline.backlog", sum(q.qsize() for q in queues))
+                yield item
+        finally:
+            stop.set()
+
+
+def fetch(
+    directory: Union[Path, PackedStore],
+    files: Iterable[Union[ObjectSummary, Object]],
+    workers: int = 10,
+    ignore_missing: bool = True,
+) -> Pipeline:
+    """A pipeline of (key, local file) for all files, downloading those that are not cached yet."""
+
+    def download(file) -> Optional[tuple[str, Union[Path, PackedFile]]]:
+        _, key, local = download_file(directory, file, ignore_missing)
+        return None if local is None else (key, local)
+
+    return Pipeline(files).map(download, workers=workers, name="download")
+
+
+def pipeline_options(command: Callable) -> Callable:
+    """--download-workers and --workers options for commands built on fetch()."""
+    command = click.option("--workers", default=4, show_default=True, type=click.IntRange(min=1),
+                           help="threads decoding and analyzing files.")(command)
+    return click.option("--download-workers", default=10, show_default=True, type=click.IntRange(min=1),
+                        help="concurrent S3 downloads.")(command)
@@ -0,0 +1,140 @@
+"""
+Lightweight instrumentation: nested spans, counters and histograms.
+
+Everything is a no-op until `enable()` is called (`adm --profile out.json`).
+`export()` writes a JSON summary and a Chrome trace (chrome://tracing, https://ui.perfetto.dev).
+"""
+import collections
+import contextlib
+import os
+import statistics
+import threading
+import time
+from collections.abc import Generator
+from pathlib import Path
+from typing import Any
+
+import orjson as json
+
+enabled = False
+
+_lock = threading.Lock()
+_local = threading.local()
+_t0 = time.perf_counter()
+_events: list[dict[str, Any]] = []
+counters: collections.Counter[str] = collections.Counter()
+histograms: dict[str, list[float]] = collections.defaultdict(list)
+
+
+def enable() -> None:
+    global enabled
+    enabled = True
+
+
+def reset() -> None:
+    global _t0
+    with _lock:
+        _t0 = time.perf_counter()
+        _events.clear()
+        counters.clear()
+        histograms.clear()
+
+
+def count(name: str, n: int = 1) -> None:
+    if enabled:
+        with _lock:
+            counters[name] += n
+
+
+def observe(name: str, value: float) -> None:
+    if enabled:
+        with _lock:
+            histograms[name].append(value)
+
+
+def _stack() -> list[str]:
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+
+@contextlib.contextmanager
+def span(name: str, **args: Any) -> Generator[None]:
+    """Time a block. Spans nest per thread; the summary aggregates them by their full path."""
+    if not enabled:
+        yield
+        return
+    stack = _stack()
+    stack.append(name)
+    path = "/".join(stack)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        stack.pop()
+        with _lock:
+            _events.append({
+                "name": name,
+                "path": path,
+                "ts": (start - _t0) * 1e6,
+                "dur": (end - start) * 1e6,
+                "tid": threading.get_ident(),
+                "args": args,
+            })
+
+
+def _distribution(values: list[float]) -> dict[str, float]:
+    values = sorted(values)
+    if len(values) > 1:
+        p50, p90, p99 = [statistics.quantiles(values, n=100, method="inclusive")[i - 1] for i in (50, 90, 99)]
+    else:
+        p50 = p90 = p99 = values[0]
+    return {
+        "count": len(values),
+        "sum": sum(values),
+        "min": values[0],
+        "mean": statistics.fmean(values),
+        "p50": p50,
+        "p90": p90,
+        "p99": p99,
+        "max": values[-1],
+    }
+
+
+def summary() -> dict[str, Any]:
+    with _lock:
+        spans = collections.defaultdict(list)
+        for e in _events:
+            spans[e["path"]].append(e["dur"] / 1e6)
+        return {
+            "spans": {path: _distribution(durations) for path, durations in sorted(spans.items())},
+            "counters": dict(sorted(counters.items())),
+            "histograms": {name: _distribution(values) for name, values in sorted(histograms.items()) if values},
+        }
+
+
+def chrome_trace() -> dict[str, Any]:
+    pid = os.getpid()
+    with _lock:
+        events = [
+            {"name": e["name"], "ph": "X", "ts": e["ts"], "dur": e["dur"], "pid": pid, "tid": e["tid"], "args": e["args"]}
+            for e in _events
+        ]
+        end = (time.perf_counter() - _t0) * 1e6
+        events.extend(
+            {"name": name, "ph": "C", "ts": end, "pid": pid, "tid": 0, "args": {name: value}}
+            for name, value in counters.items()
+        )
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def export(path: Path) -> tuple[Path, Path]:
+    """Write the summary to path and the Chrome trace next to it (*.trace.json)."""
+    path = Path(path)
+    trace = path.with_name(f"{path.stem}.trace.json")
+    path.write_bytes(json.dumps(summary(), option=json.OPT_INDENT_2))
+    trace.write_bytes(json.dumps(chrome_trace()))
+    return path, trace
@@ -0,0 +1,143 @@
+"""
+Vectorized permutation tests and bootstrap confidence intervals for differences in mean keyword hits
+between two conditions (e.g. consent_accept vs. consent_reject), for all keyword groups at once.
+
+Resamples are drawn in chunks as 0/1 (permutation) or draw count (bootstrap) matrices,
+so that every chunk is a single matrix product with the site × group count matrix.
+Chunks are sized to stay below max_bytes and are seeded independently, so results do not depend on
+the number of processes.
+"""
+import concurrent.futures
+from collections.abc import Sequence
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from admeasure_py.utils import keywords
+
+MAX_BYTES = 256 * 1024 ** 2
+
+# set per worker process, see _init
+_X: Optional[np.ndarray] = None
+_mask: Optional[np.ndarray] = None
+
+
+def keyword_groups(counts: pd.DataFrame) -> pd.DataFrame:
+    """Sum pattern columns (see fast_re) into keyword group columns. Columns that already are groups are kept."""
+    groups = {}
+    for group, kw in keywords().items():
+        if group in counts.columns:
+            groups[group] = counts[group]
+        elif cols := [p for p in kw["patterns"] if p in counts.columns]:
+            groups[group] = counts[cols].sum(axis=1)
+    return pd.DataFrame(groups, index=counts.index)
+
+
+def _init(X: np.ndarray, mask: np.ndarray) -> None:
+    global _X, _mask
+    _X = X
+    _mask = mask
+
+
+def _permutation_chunk(seed: np.random.SeedSequence, k: int) -> np.ndarray:
+    """Mean differences (k × groups) for k random relabelings."""
+    rng = np.random.default_rng(seed)
+    n_a = int(_mask.sum())
+    n_b = len(_mask) - n_a
+    # the n_a sites with the smallest random keys form condition a, partitioning is much faster than shuffling.
+    keys = rng.random((k, len(_mask)))
+    kth = np.partition(keys, n_a - 1, axis=1)[:, n_a - 1]
+    sum_a = (keys <= kth[:, None]).astype(_X.dtype) @ _X
+    sum_b = _X.sum(axis=0) - sum_a
+    return sum_a / n_a - sum_b / n_b
+
+
+def _bootstrap_weights(rng: np.random.Generator, n: int, k: int) -> np.ndarray:
+    """How often each of n sites is drawn in each of k samples with replacement (k × n)."""
+    idx = rng.integers(0, n, (k, n))
+    idx += np.arange(k)[:, None] * n
+    return np.bincount(idx.ravel(), minlength=k * n).reshape(k, n).astype(_X.dtype)
+
+
+def _bootstrap_chunk(seed: np.random.SeedSequence, k: int) -> np.ndarray:
+    """Mean differences (k × groups) for k bootstrap samples, drawn within each condition."""
+    rng = np.random.default_rng(seed)
+    X_a = _X[_mask]
+    X_b = _X[~_mask]
+    return (_bootstrap_weights(rng, len(X_a), k) @ X_a) / len(X_a) - (_bootstrap_weights(rng, len(X_b), k) @ X_b) / len(X_b)
+
+
+def _chunks(n: int, sites: int, max_bytes: int) -> list[int]:
+    size = max(1, min(n, max_bytes // (sites * 8 * 3)))
+    return [min(size, n - i) for i in range(0, n, size)]
+
+
+def resample(
+    kind: str,
+    X: np.ndarray,
+    mask: np.ndarray,
+    n: int,
+    seed: int = 0,
+    max_bytes: int = MAX_BYTES,
+    processes: int = 0,
+) -> np.ndarray:
+    """n resampled mean differences (n × groups), kind is "permutation" or "bootstrap"."""
+    fn = {"permutation": _permutation_chunk, "bootstrap": _bootstrap_chunk}[kind]
+    X = np.asarray(X, dtype=np.float64)
+    mask = np.asarray(mask, dtype=bool)
+    sizes = _chunks(n, len(X), max_bytes)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if processes > 1:
+        with concurrent.futures.ProcessPoolExecutor(processes, initializer=_init, initargs=(X, mask)) as executor:
+            parts = list(executor.map(fn, seeds, sizes))
+    else:
+        _init(X, mask)
+        parts = [fn(s, k) for s, k in zip(seeds, sizes)]
+    return np.concatenate(parts) if parts else np.empty((0, X.shape[1]))
+
+
+def effects(
+    counts: pd.DataFrame,
+    labels: Sequence,
+    a: str,
+    b: str,
+    permutations: int = 10_000,
+    bootstraps: int = 10_000,
+    alpha: float = 0.05,
+    seed: int = 0,
+    max_bytes: int = MAX_BYTES,
+    processes: int = 0,
+) -> pd.DataFrame:
+    """
+    Effect of condition a vs. b on the mean count of every column of counts (sites × groups):
+    difference and ratio of means, a percentile bootstrap CI of the difference and a two-sided permutation p-value.
+    Sites with other labels are ignored.
+    """
+    labels = np.asarray(labels)
+    keep = (labels == a) | (labels == b)
+    X = counts.to_numpy(dtype=np.float64)[keep]
+    mask = labels[keep] == a
+    if mask.all() or not mask.any():
+        raise ValueError(f"need sites labeled both {a!r} and {b!r}.")
+
+    mean_a = X[mask].mean(axis=0)
+    mean_b = X[~mask].mean(axis=0)
+    observed = mean_a - mean_b
+
+    df = pd.DataFrame({
+        "n_a": int(mask.sum()),
+        "n_b": int((~mask).sum()),
+        "mean_a": mean_a,
+        "mean_b": mean_b,
+        "diff": observed,
+        "ratio": np.divide(mean_a, mean_b, out=np.full_like(mean_a, np.nan), where=mean_b != 0),
+    }, index=counts.columns)
+    if bootstraps:
+        boot = resample("bootstrap", X, mask, bootstraps, seed, max_bytes, processes)
+        df["ci_low"], df["ci_high"] = np.quantile(boot, [alpha / 2, 1 - alpha / 2], axis=0)
+    if permutations:
+        perm = resample("permutation", X, mask, permutations, seed + 1, max_bytes, processes)
+        # the observed labeling counts as one permutation, so p is never 0
+        df["p"] = ((np.abs(perm) >= np.abs(observed) - 1e-12).sum(axis=0) + 1) / (permutations + 1)
+    return df
@@ -0,0 +1,179 @@
+"""
+Memoized analysis stages.
+
+Each stage result is pickled into a SQLite file, keyed by a hash of the stage name, its version and its inputs.
+Run data on S3 is immutable, so per-file results are keyed by object id and size. Re-running an analysis after
+new runs landed only computes the new files/runs and re-assembles the aggregates from cached parts.
+Bump a stage's version whenever its code changes.
+"""
+import hashlib
+import pickle
+import sqlite3
+import threading
+from collections.abc import Callable, Iterable
+from pathlib import Path
+from typing import Any, TypeVar, Union
+
+from admeasure_py import profiling
+from admeasure_py.packed import PackedFile
+from admeasure_py.utils import json
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# language="SQL"
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    stage TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (stage, key)
+);
+"""
+
+
+def fingerprint(file: Union[Path, PackedFile]) -> int:
+    """Cheap content fingerprint of a cached S3 object."""
+    if isinstance(file, PackedFile):
+        return file.size()
+    return file.stat().st_size
+
+
+def hash_key(*parts: Any) -> str:
+    return hashlib.blake2b(
+        json.dumps(parts, option=json.OPT_SERIALIZE_NUMPY | json.OPT_NON_STR_KEYS, default=str),
+        digest_size=16,
+    ).hexdigest()
+
+
+class Memo:
+    path: Path
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # streaming stages store results one by one, don't sync on every commit.
+        self._conn.executescript("PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;" + SCHEMA)
+
+    def stage(self, name: str, version: int = 1) -> "Stage":
+        return Stage(self, name, version)
+
+    def get_many(self, stage: str, keys: list[str]) -> dict[str, Any]:
+        found = {}
+        with self._lock:
+            # stay below SQLite's limit on host parameters
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                found.update(self._conn.execute(
+                    f"SELECT key, value FROM results WHERE stage = ? AND key IN ({','.join('?' * len(chunk))})",
+                    [stage, *chunk]
+                ))
+        return {k: pickle.loads(v) for k, v in found.items()}
+
+    def put_many(self, stage: str, values: dict[str, Any]) -> None:
+        rows = [(stage, k, pickle.dumps(v, protocol=pickle.HIGHEST_PROTOCOL)) for k, v in values.items()]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?)", rows)
+
+    def replace(self, stage: str, key: str, value: Any) -> bytes:
+        """Store value as the only result of stage, return its pickled form."""
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM results WHERE stage = ?", (stage,))
+            self._conn.execute("INSERT INTO results VALUES (?, ?, ?)", (stage, key, blob))
+        return blob
+
+    def clear(self, stage_prefix: str = "") -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM results WHERE stage LIKE ?", (f"{stage_prefix}%",))
+
+
+class Stage:
+    memo: Memo
+    name: str
+    version: int
+
+    def __init__(self, memo: Memo, name: str, version: int):
+        self.memo = memo
+        self.name = name
+        self.version = version
+
+    @property
+    def _stage(self) -> str:
+        return f"{self.name}@{self.version}"
+
+    def key(self, *inputs: Any) -> str:
+        return hash_key(self.name, self.version, *inputs)
+
+    def map(self, items: dict[str, T], fn: Callable[[str, T], R], key_parts: Callable[[str, T], Any]) -> dict[str, R]:
+        """
+        Apply fn(id, item) to every item, reusing cached results whose key_parts(id, item) did not change.
+        Results are returned sorted by id, independent of which ones were cached.
+        """
+        keys = {id: self.key(id, key_parts(id, item)) for id, item in items.items()}
+        cached = self.memo.get_many(self._stage, list(keys.values()))
+        computed = {}
+        results = {}
+        with profiling.span(self.name):
+            for id in sorted(items):
+                key = keys[id]
+                if key in cached:
+                    results[id] = cached[key]
+                else:
+                    results[id] = computed[key] = fn(id, items[id])
+        profiling.count(f"stage.{self.name}.hits", len(items) - len(computed))
+        profiling.count(f"stage.{self.name}.misses", len(computed))
+        if computed:
+            self.memo.put_many(self._stage, computed)
+        return results
+
+    def map_files(self, files: dict[str, Union[Path, PackedFile]], fn: Callable[[str, Union[Path, PackedFile]], R],
+                  *extra: Any) -> dict[str, R]:
+        """Stage.map for downloaded S3 objects, keyed by object id, size and any extra inputs."""
+        return self.map(files, fn, lambda id, f: (fingerprint(f), *extra))
+
+    def cached(self, fn: Callable[[str, T], R], key_parts: Callable[[str, T], Any]) -> Callable[[tuple[str, T]], tuple[str, R]]:
+        """
+        Per-item version of Stage.map for streaming pipelines: the returned function maps (id, item) to (id, result)
+        and shares its cache entries with Stage.map.
+        """
+
+        def apply(x: tuple[str, T]) -> tuple[str, R]:
+            id, item = x
+            key = self.key(id, key_parts(id, item))
+            if key in (cached := self.memo.get_many(self._stage, [key])):
+                profiling.count(f"stage.{self.name}.hits")
+                return id, cached[key]
+            profiling.count(f"stage.{self.name}.misses")
+            value = fn(id, item)
+            self.memo.put_many(self._stage, {key: value})
+            return id, value
+
+        return apply
+
+    def cached_files(self, fn: Callable[[str, Union[Path, PackedFile]], R], *extra: Any
+                     ) -> Callable[[tuple[str, Union[Path, PackedFile]]], tuple[str, R]]:
+        """Stage.cached for downloaded S3 objects, see Stage.map_files."""
+        return self.cached(fn, lambda id, f: (fingerprint(f), *extra))
+
+    def compute(self, inputs: Iterable[Any], fn: Callable[[], R]) -> R:
+        """Compute a single value (e.g. an aggregate) keyed by the given inputs. Only the latest value is kept."""
+        key = self.key(*inputs)
+        if key in (cached := self.memo.get_many(self._stage, [key])):
+            profiling.count(f"stage.{self.name}.hits")
+            return cached[key]
+        profiling.count(f"stage.{self.name}.misses")
+        with profiling.span(self.name):
+            value = fn()
+        # return the stored round-trip, so that fresh and cached results are indistinguishable
+        # (e.g. concatenated frames are otherwise serialized in chunks by to_feather).
+        return pickle.loads(self.memo.replace(self._stage, key, value))
+
+
+def group_by_run(ids: Iterable[str]) -> dict[str, list[str]]:
+    """Group {run_id}/{part-i}/{file} ids by their run id."""
+    runs: dict[str, list[str]] = {}
+    for id in sorted(ids):
+        runs.setdefault(id.rpartition("/")[0].rpartition("/")[0], []).append(id)
+    return runs
@@ -3,18 +3,21 @@ import concurrent.futures
 import contextlib
 import gzip
 import io
+import os
 import sys
 
 import orjson as json
 import re
+import runpy
 import subprocess
 import tempfile
 import textwrap
+import threading
 import time
 from collections.abc import Generator
 from functools import cache
 from pathlib import Path
-from typing import TypeVar, TypedDict, Union
+from typing import TYPE_CHECKING, Any, Optional, TypeVar, TypedDict, Union
 
 import boto3
 import botocore.exceptions
@@ -23,16 +26,22 @@ from mypy_boto3_s3 import Client
 from mypy_boto3_s3.service_resource import Bucket, Object, ObjectSummary
 from publicsuffix2 import PublicSuffixList
 
+from admeasure_py import profiling, zdict
+
+if TYPE_CHECKING:
+    from admeasure_py.packed import PackedFile, PackedStore
+
 MeasurementPlanV3 = dict
 
 here = Path(__file__).parent
 
 
 def s3_bucket() -> Bucket:
-    session = boto3.session.Session(profile_name="admeasure")
+    # both can be overridden to point the tooling at a local S3 stand-in (minio, moto_server, ...)
+    session = boto3.session.Session(profile_name=os.environ.get("ADMEASURE_S3_PROFILE", "admeasure") or None)
     bucket = session.resource(
         "s3",
-        endpoint_url="https://s3.eu-central-1.amazonaws.com"
+        endpoint_url=os.environ.get("ADMEASURE_S3_ENDPOINT", "https://s3.eu-central-1.amazonaws.com")
     ).Bucket("admeasure")
     return bucket
 
@@ -168,9 +177,12 @@ class timeit(contextlib.ContextDecorator):
             print(self.message, end="\u2026")
         else:
             print(self.message + "\u2026\n", end="")
+        self.span = profiling.span(self.message)
+        self.span.__enter__()
         self.start = time.time()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self.span.__exit__(exc_type, exc_val, exc_tb)
         if not self.short:
             print(f"{self.message}: ", end="")
         print(f"{time.time() - self.start:.1f}s")
@@ -188,27 +200,55 @@ def get_from_s3(filename: Union[str, ObjectSummary], default: T = _raise) -> Uni
     bucket = s3_bucket()
     buf = io.BytesIO()
     try:
-        bucket.download_fileobj(filename, buf)
+        with profiling.span("download", key=filename):
+            bucket.download_fileobj(filename, buf)
     except ClientError:
         if default is not _raise:
             return default
         raise
-    try:
-        return gzip.decompress(buf.getvalue())
-    except gzip.BadGzipFile:
-        return buf.getvalue()
+    profiling.count("s3.bytes_downloaded", buf.tell())
+    return zdict.decode(buf.getvalue())
 
 
-def download_files_from_s3(
-    directory: Path,
-    files: list[Union[ObjectSummary, Object]],
+@cache
+def analysis(name: str) -> dict[str, Any]:
+    """The globals of an analysis' run.py, loaded only once per process."""
+    return runpy.run_path(str(here / f"../{name}/run.py"))
+
+
+@contextlib.contextmanager
+def cache_backend(directory: Path) -> Generator[Union[Path, "PackedStore"]]:
+    """
+    The local cache for an analysis: a directory with one file per object (default),
+    or a packed store next to it if ADMEASURE_CACHE_BACKEND=packed, which is closed on exit.
+    """
+    if os.environ.get("ADMEASURE_CACHE_BACKEND", "files") == "packed":
+        from admeasure_py.packed import PackedStore
+
+        with PackedStore(directory.with_name(f"{directory.name}.pack")) as store:
+            yield store
+    else:
+        yield directory
+
+
+def download_file(
+    directory: Union[Path, "PackedStore"],
+    file: Union[ObjectSummary, Object],
     ignore_missing: bool = True,
-) -> dict[str, Path]:
-    def download_file(file):
+) -> tuple[bool, str, Optional[Union[Path, "PackedFile"]]]:
+    """Download a single object into the cache unless it is already there. Returns (cached, key, local file)."""
+    packed = not isinstance(directory, Path)
+    if packed:
+        outfile = directory.file(file.key)
+    else:
         outfile = directory / id_to_path(file.key)
-        if outfile.exists():
-            return True, file.key, outfile
+    if outfile.exists():
+        profiling.count("cache.hits")
+        return True, file.key, outfile
+    profiling.count("cache.misses")
+    if not packed:
         outfile.parent.mkdir(parents=True, exist_ok=True)
+    with profiling.span("download", key=file.key):
         try:
             obj = file.get()
         except botocore.exceptions.ClientError:
@@ -216,17 +256,32 @@ def download_files_from_s3(
                 return False, file.key, None
             else:
                 raise
+        profiling.count("s3.bytes_downloaded", obj["ContentLength"])
+        if packed:
+            # keep the body compressed as it is, it is only decompressed when read.
+            directory.put(file.key, obj["Body"].read(), compressed=obj.get("ContentEncoding") == "gzip")
+            return False, file.key, outfile
         f = obj["Body"]
         if obj["ContentEncoding"] == "gzip":
             f = gzip.GzipFile(fileobj=f)
         content = f.read()
-        outfile.write_bytes(content)
-        return False, file.key, outfile
+        profiling.observe("s3.object_bytes", len(content))
+        # write atomically, an interrupted write must not leave a truncated file that counts as cached.
+        tmp = outfile.with_name(f"{outfile.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+        tmp.write_bytes(content)
+        tmp.replace(outfile)
+    return False, file.key, outfile
+
 
+def download_files_from_s3(
+    directory: Union[Path, "PackedStore"],
+    files: list[Union[ObjectSummary, Object]],
+    ignore_missing: bool = True,
+) -> dict[str, Union[Path, "PackedFile"]]:
     local_files = {}
     with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor, timeit("downloading missing files from s3"):
         futures = [
-            executor.submit(download_file, file)
+            executor.submit(download_file, directory, file, ignore_missing)
             for file in files
         ]
         downloads = 0
@@ -244,6 +299,12 @@ def download_files_from_s3(
     return local_files
 
 
+def list_objects(prefix: str) -> Generator[ObjectSummary]:
+    for file in s3_bucket().objects.filter(Prefix=prefix):
+        profiling.count("s3.objects_listed")
+        yield file
+
+
 def enumerate_bucket(prefix: str, delimiter: str) -> Generator[str]:
     prefixes = 0
     start = time.time()
@@ -252,13 +313,22 @@ def enumerate_bucket(prefix: str, delimiter: str) -> Generator[str]:
     bucket = s3_bucket()
     paginator = client.get_paginator("list_objects")
     for i, result in enumerate(paginator.paginate(Bucket=bucket.name, Prefix=prefix, Delimiter=delimiter)):
+        profiling.count("s3.list_pages")
         for prefix in result.get("CommonPrefixes", []):
             prefixes += 1
+            profiling.count("s3.prefixes_listed")
             yield prefix["Prefix"]
         print(
             f"Enumerating bucket... {prefixes} entries after {i + 1} pages ({prefixes / (time.time() - start):.1f} entries/s)")
 
 
+def read_json(file: Path):
+    data = zdict.decode(file.read_bytes())
+    profiling.count("files.parsed")
+    profiling.count("files.bytes_parsed", len(data))
+    return json.loads(data)
+
+
 def id_to_path(id: str) -> str:
     return id.replace(":", "-")
 
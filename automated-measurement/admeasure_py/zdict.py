@@ -0,0 +1,126 @@
+"""
+Trained zstd dictionaries for the small, repetitive JSON artifacts (console.json, consent.json, cookies.json, ...).
+
+Dictionaries live in admeasure_py/zdicts/{artifact}.zdict. Every zstd frame records the id of its dictionary,
+so `decode` can read gzip, zstd (with or without dictionary) and plain data transparently.
+"""
+import gzip
+import threading
+from collections.abc import Iterable
+from functools import cache
+from pathlib import Path
+from typing import Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+here = Path(__file__).parent
+
+dict_dir = here / "zdicts"
+
+ARTIFACTS = ["console.json", "consent.json", "cookies.json", "contents.json"]
+DICT_SIZE = 112 * 1024
+LEVEL = 19
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+_local = threading.local()
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise RuntimeError("zstandard is not installed, zstd-compressed artifacts cannot be used.")
+
+
+def artifact_type(key: str) -> str:
+    return key.rpartition("/")[2]
+
+
+@cache
+def dictionaries() -> dict[int, "zstandard.ZstdCompressionDict"]:
+    """All available dictionaries by dictionary id."""
+    if zstandard is None:
+        return {}
+    ds = {}
+    for f in sorted(dict_dir.glob("*.zdict")):
+        d = zstandard.ZstdCompressionDict(f.read_bytes())
+        ds[d.dict_id()] = d
+    return ds
+
+
+@cache
+def dictionary_for(artifact: str) -> Optional["zstandard.ZstdCompressionDict"]:
+    f = dict_dir / f"{artifact}.zdict"
+    if zstandard is None or not f.exists():
+        return None
+    return zstandard.ZstdCompressionDict(f.read_bytes())
+
+
+def train(samples: list[bytes], size: int = DICT_SIZE, level: int = LEVEL) -> "zstandard.ZstdCompressionDict":
+    _require_zstandard()
+    return zstandard.train_dictionary(size, samples, level=level)
+
+
+def save_dictionary(artifact: str, d: "zstandard.ZstdCompressionDict") -> Path:
+    dict_dir.mkdir(exist_ok=True)
+    out = dict_dir / f"{artifact}.zdict"
+    out.write_bytes(d.as_bytes())
+    dictionaries.cache_clear()
+    dictionary_for.cache_clear()
+    return out
+
+
+def compress(data: bytes, d: Optional["zstandard.ZstdCompressionDict"] = None, level: int = LEVEL) -> bytes:
+    _require_zstandard()
+    return zstandard.ZstdCompressor(level=level, dict_data=d, write_content_size=True).compress(data)
+
+
+def _decompressor(dict_id: int) -> "zstandard.ZstdDecompressor":
+    # decompressors are cheap to reuse but must not be used from multiple threads at once.
+    try:
+        cache = _local.decompressors
+    except AttributeError:
+        cache = _local.decompressors = {}
+    if dict_id not in cache:
+        if dict_id and dict_id not in dictionaries():
+            raise KeyError(f"zstd dictionary {dict_id} not found in {dict_dir}.")
+        cache[dict_id] = zstandard.ZstdDecompressor(dict_data=dictionaries().get(dict_id))
+    return cache[dict_id]
+
+
+def decode(data: bytes) -> bytes:
+    """Decompress gzip or zstd data, pass everything else through."""
+    if data[:2] == GZIP_MAGIC:
+        return gzip.decompress(data)
+    if data[:4] == ZSTD_MAGIC:
+        _require_zstandard()
+        return _decompressor(zstandard.get_frame_parameters(data).dict_id).decompress(data)
+    return data
+
+
+def recompress_files(files: Iterable[Path], dry_run: bool = False) -> tuple[int, int, int]:
+    """
+    Recompress cached files in place with their artifact's dictionary.
+    Returns (files recompressed, bytes before, bytes after).
+    """
+    count = before = after = 0
+    for f in files:
+        d = dictionary_for(artifact_type(f.name))
+        if d is None:
+            continue
+        raw = f.read_bytes()
+        if raw[:4] == ZSTD_MAGIC and zstandard.get_frame_parameters(raw).dict_id == d.dict_id():
+            continue
+        out = compress(decode(raw), d)
+        count += 1
+        before += len(raw)
+        after += len(out)
+        if not dry_run:
+            tmp = f.with_name(f"{f.name}.tmp")
+            tmp.write_bytes(out)
+            tmp.replace(f)
+    return count, before, after
+
@@ -6,7 +6,10 @@ from pathlib import Path
 
 import click
 
-from admeasure_py.utils import download_files_from_s3, s3_bucket, json
+from admeasure_py import profiling
+from admeasure_py.pipeline import fetch, pipeline_options
+from admeasure_py.stages import Memo
+from admeasure_py.utils import cache_backend, json, list_objects, read_json
 
 today = date.today().isoformat()
 
@@ -17,28 +20,33 @@ cache_dir = here / "cache"
 
 @click.command()
 @click.argument("prefix", default=f"consent-test/{today}", required=False)
-def cli(prefix):
-    bucket = s3_bucket()
-    s3_manager_files = []
-    s3_modal_files = []
-
-    for file in bucket.objects.filter(Prefix=prefix):
-        if file.key.endswith("sourcepoint-manager.json"):
-            s3_manager_files.append(file)
-        elif file.key.endswith("sourcepoint-modal.json"):
-            s3_modal_files.append(file)
-
-    print(f"{len(s3_modal_files)} modal and {len(s3_manager_files)} manager files found.")
-
-    manager_files = download_files_from_s3(cache_dir, s3_manager_files).values()
-    modal_files = download_files_from_s3(cache_dir, s3_modal_files).values()
-
-    manager_data = [
-        json.loads(f.read_bytes())
-        for f in manager_files
-    ]
-
-    modal = [json.loads(f.read_bytes()) for f in modal_files]
+@pipeline_options
+def cli(prefix, download_workers, workers):
+    def sourcepoint_objects():
+        with profiling.span("list"):
+            for file in list_objects(prefix):
+                if file.key.endswith("sourcepoint-manager.json") or file.key.endswith("sourcepoint-modal.json"):
+                    yield file
+
+    memo = Memo(here / "stages.sqlite")
+    read_manager = memo.stage("button-texts.manager").cached_files(
+        lambda id, f: {k: v for k, v in read_json(f).items() if k in ("types", "buttons", "actions", "actionParents")},
+    )
+    read_modal = memo.stage("button-texts.modal").cached_files(lambda id, f: read_json(f))
+
+    manager_results = {}
+    modal_results = {}
+    with cache_backend(cache_dir) as cache:
+        for id, data in fetch(cache, sourcepoint_objects(), download_workers).map(
+                lambda x: read_manager(x) if x[0].endswith("sourcepoint-manager.json") else read_modal(x), workers,
+                name="read"):
+            (manager_results if id.endswith("sourcepoint-manager.json") else modal_results)[id] = data
+
+    print(f"{len(modal_results)} modal and {len(manager_results)} manager files found.")
+
+    # sorted by id, independent of the download order.
+    manager_data = [manager_results[id] for id in sorted(manager_results)]
+    modal = [modal_results[id] for id in sorted(modal_results)]
     types = [m["types"] for m in manager_data]
     buttons = [m["buttons"] for m in manager_data]
     actions = [m["actions"] for m in manager_data]
@@ -1,12 +1,19 @@
 #!/usr/bin/env python3
 from datetime import date
 from pathlib import Path
+from typing import Optional, Union
 
 import click
 import pandas as pd
 import statsmodels.formula.api as smf
+from mypy_boto3_s3.service_resource import ObjectSummary
 
-from admeasure_py.utils import bash, download_files_from_s3, get_from_s3, json, s3_bucket
+from admeasure_py import profiling
+from admeasure_py.index import index_plans, plan_attributes
+from admeasure_py.packed import PackedStore
+from admeasure_py.pipeline import fetch, pipeline_options
+from admeasure_py.stages import Memo, fingerprint, group_by_run
+from admeasure_py.utils import bash, cache_backend, get_from_s3, list_objects, read_json
 
 today = date.today().isoformat()
 
@@ -31,80 +38,138 @@ def measure():
     """)
 
 
-@cli.command()
-@click.argument("prefix", default=f"consent-test/{today}", required=False)
-def analyze(prefix):
-    bucket = s3_bucket()
-    s3_consent_files = []
-    s3_plan_files = []
-
-    for file in bucket.objects.filter(Prefix=prefix):
-        if file.key.endswith("consent.json"):
-            s3_consent_files.append(file)
-        elif file.key.endswith("plan.json"):
-            s3_plan_files.append(file)
-
-    print(f"{len(s3_plan_files)} plans and {len(s3_consent_files)} consent files found.")
-
-    if len(s3_plan_files) == len(s3_consent_files) == 0:
-        return
-
-    consent_files = download_files_from_s3(cache_dir, s3_consent_files)
-    plan_files = download_files_from_s3(cache_dir, s3_plan_files).values()
-
-    plans = {}
-    for f in plan_files:
-        data = json.loads(f.read_bytes())
-        plans[data["id"]] = data
-
-    contents = {}
-    for id, f in consent_files.items():
-        data = json.loads(f.read_bytes())
-        site_id = id.rpartition("/")[0]
-        plan_id = site_id.rpartition("/")[0]
-        data["plan"] = plans[plan_id]
-        data["id"] = site_id
-        contents[site_id] = data
-
-    for c in contents.values():
-        if c["version"] == 2:
-            tcData = c["tcData"].get("useractioncomplete") or c["tcData"].get("tcloaded") or {}
-            c["cmpId"] = tcData.get("cmpId") or (c["pingLoaded"] or {}).get("cmpId") or (c["pingWaiting"] or {}).get(
-                "cmpId")
-
-    df = pd.DataFrame(contents.values())
+def site_record(id: str, data: dict) -> dict:
+    """Turn the contents of a {site_id}/consent.json into a flat record."""
+    site_id = id.rpartition("/")[0]
+    data["plan_id"] = site_id.rpartition("/")[0]
+    data["id"] = site_id
+    if data["version"] == 2:
+        tcData = data["tcData"].get("useractioncomplete") or data["tcData"].get("tcloaded") or {}
+        data["cmpId"] = tcData.get("cmpId") or (data["pingLoaded"] or {}).get("cmpId") or (data["pingWaiting"] or {}).get(
+            "cmpId")
+    return data
+
+
+def outcome(row):
+    if row.consent is None:
+        return "0_err"
+    if row.consent and row.legInt:
+        return "4_both"
+    if row.consent:
+        return "3_consent"
+    if row.legInt:
+        return "2_legInt"
+    return "1_neither"
+
+
+def correctness(row):
+    should_accept = row.strategy == "consent_accept"
+    if should_accept == row.consent == row.legInt:
+        return 1
+    if row.consent == row.legInt:
+        return 0
+    return 0.25
+
+
+def results_frame(records: list[dict], plans: pd.DataFrame) -> pd.DataFrame:
+    """One row per site with a known CMP, joined with the plan's location and device."""
+    df = pd.DataFrame(records)
+    df = df.join(plans[["region", "device"]].rename(columns={"region": "location"}), on="plan_id")
     df = df[df.cmpId.isin([6, 10, 28])]
 
-    def outcome(row):
-        if row.consent is None:
-            return "0_err"
-        if row.consent and row.legInt:
-            return "4_both"
-        if row.consent:
-            return "3_consent"
-        if row.legInt:
-            return "2_legInt"
-        return "1_neither"
-
-    def correctness(row):
-        should_accept = row.strategy == "consent_accept"
-        if should_accept == row.consent == row.legInt:
-            return 1
-        if row.consent == row.legInt:
-            return 0
-        return 0.25
-
     df["outcome"] = df.apply(outcome, axis=1)
     df["correctness"] = df.apply(correctness, axis=1)
     df["cmp"] = df.cmpId.apply(lambda id: {6: "Sourcepoint", 10: "Quantcast", 28: "OneTrust"}[id])
-    df["location"] = df.plan.apply(lambda p: p["region"])
-    df["device"] = df.plan.apply(lambda p: p["device"]["type"])
-    df = df[
+    return df[
         ["cmp", "url", "location", "device", "strategy", "consent", "legInt", "outcome", "correctness", "id"]
     ].reset_index(drop=True)
+
+
+def outcome_distribution(df: pd.DataFrame) -> pd.DataFrame:
+    return df.groupby(["cmp", "strategy"]).outcome.value_counts(normalize=True).unstack(fill_value=0)
+
+
+def results(consent_files: dict[str, Path], plans: pd.DataFrame, memo: Memo,
+            records: Optional[dict[str, dict]] = None) -> pd.DataFrame:
+    """
+    results_frame over all consent files, computed per run and reusing everything that is cached.
+    Pass records if they were already read (see stream_records).
+    """
+    if records is None:
+        records = memo.stage("consent-test.record").map_files(
+            consent_files,
+            lambda id, f: site_record(id, read_json(f)),
+        )
+    runs = group_by_run(records)
+    run_inputs = {
+        run_id: (
+            [(id, fingerprint(consent_files[id])) for id in ids],
+            plans.loc[run_id].to_dict() if run_id in plans.index else None,
+        )
+        for run_id, ids in runs.items()
+    }
+    frames = memo.stage("consent-test.run_frame").map(
+        runs,
+        lambda run_id, ids: results_frame([records[id] for id in ids], plans),
+        lambda run_id, ids: run_inputs[run_id],
+    )
+    # empty frames lose the column dtypes, skip them unless there is nothing else.
+    frames = [f for f in frames.values() if not f.empty] or list(frames.values())[:1]
+    return memo.stage("consent-test.results").compute(
+        sorted(run_inputs.items()),
+        lambda: pd.concat(frames, ignore_index=True),
+    )
+
+
+def stream_records(prefix: str, cache: Union[Path, PackedStore], memo: Memo, download_workers: int, workers: int
+                   ) -> tuple[dict[str, Path], dict[str, dict], list[ObjectSummary]]:
+    """
+    Download and read all consent files under prefix into cache (see cache_backend) in one pipeline.
+    Returns (files, records, plan files).
+    """
+    s3_plan_files = []
+
+    def consent_objects():
+        with profiling.span("list"):
+            for file in list_objects(prefix):
+                if file.key.endswith("consent.json"):
+                    yield file
+                elif file.key.endswith("plan.json"):
+                    s3_plan_files.append(file)
+
+    record = memo.stage("consent-test.record").cached_files(lambda id, f: site_record(id, read_json(f)))
+    consent_files = {}
+    records = {}
+    for (id, f), (_, r) in fetch(cache, consent_objects(), download_workers).map(
+            lambda x: (x, record(x)), workers, name="record"):
+        consent_files[id] = f
+        records[id] = r
+    return consent_files, records, s3_plan_files
+
+
+@cli.command()
+@click.argument("prefix", default=f"consent-test/{today}", required=False)
+@click.option("--fresh", is_flag=True, help="discard all cached stage results.")
+@pipeline_options
+def analyze(prefix, fresh, download_workers, workers):
+    memo = Memo(here / "stages.sqlite")
+    if fresh:
+        memo.clear("consent-test.")
+
+    with cache_backend(cache_dir) as cache:
+        consent_files, records, s3_plan_files = stream_records(prefix, cache, memo, download_workers, workers)
+
+        print(f"{len(s3_plan_files)} plans and {len(consent_files)} consent files found.")
+
+        if len(s3_plan_files) == len(consent_files) == 0:
+            return
+
+        index_plans(s3_plan_files, urls=False)
+
+        df = results(consent_files, plan_attributes(), memo, records)
     df.to_feather("results.feather")
 
-    dist = df.groupby(["cmp", "strategy"]).outcome.value_counts(normalize=True).unstack(fill_value=0)
+    dist = outcome_distribution(df)
     print(dist)
 
     with (here / "stats.tex").open("w", newline="\n") as f:
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+from pathlib import Path
+from typing import Optional
+
+import click
+import pandas as pd
+
+from admeasure_py.index import plan_attributes
+from admeasure_py.resample import MAX_BYTES, effects, keyword_groups
+from admeasure_py.utils import timeit
+
+here = Path(__file__).parent
+
+
+@click.group()
+def cli():
+    pass
+
+
+def read_counts(file: Path) -> pd.DataFrame:
+    if file.suffix == ".feather":
+        return pd.read_feather(file).set_index("id")
+    return pd.read_csv(file, index_col="id")
+
+
+def site_labels(counts: pd.DataFrame, label: str) -> pd.Series:
+    """A column of the counts file, or else the plan attribute of each site (see adm index update)."""
+    if label in counts.columns:
+        return counts[label].astype(str)
+    plans = plan_attributes()
+    if label not in plans.columns:
+        raise click.BadParameter(f"neither a column of the counts file nor a plan attribute ({', '.join(plans.columns)}).")
+    plan_ids = counts.index.map(lambda id: id if id in plans.index else id.rpartition("/")[0])
+    return pd.Series(plans[label].reindex(plan_ids).astype(str).to_numpy(), index=counts.index)
+
+
+@cli.command("effects")
+@click.argument("counts_file", metavar="COUNTS", type=click.Path(exists=True, dir_okay=False, path_type=Path))
+@click.option("--label", required=True, help="condition: a column of COUNTS or a plan attribute, e.g. measure_strategy.")
+@click.option("--compare", nargs=2, help="the two conditions A B to compare (default: the only two labels).")
+@click.option("--permutations", default=10_000, show_default=True)
+@click.option("--bootstraps", default=10_000, show_default=True)
+@click.option("--alpha", default=0.05, show_default=True, help="1 - confidence level of the intervals.")
+@click.option("--seed", default=0, show_default=True)
+@click.option("--max-mb", default=MAX_BYTES // 1024 ** 2, show_default=True, help="memory per chunk of resamples.")
+@click.option("--processes", default=0, show_default=True)
+@click.option("-o", "--output", type=click.Path(dir_okay=False, path_type=Path), help="write the effects as CSV.")
+def effects_cmd(counts_file: Path, label: str, compare: Optional[tuple[str, str]], permutations: int, bootstraps: int,
+                alpha: float, seed: int, max_mb: int, processes: int, output: Optional[Path]):
+    """
+    effect of a condition on keyword hits per keyword group, from a site × pattern count matrix
+    (adm har keywords --per-site -o COUNTS.csv).
+    """
+    counts = read_counts(counts_file)
+    labels = site_labels(counts, label)
+    groups = keyword_groups(counts)
+    if compare is None:
+        found = sorted(set(labels) - {"nan", "None"})
+        if len(found) != 2:
+            raise click.BadParameter(f"{label} has {len(found)} values ({', '.join(found)}), use --compare A B.")
+        compare = found
+    a, b = compare
+    print(f"{len(groups)} sites, {(labels == a).sum()} {a} vs. {(labels == b).sum()} {b}.")
+
+    with timeit(f"{permutations} permutations and {bootstraps} bootstrap samples"):
+        df = effects(groups, labels, a, b, permutations, bootstraps, alpha, seed, max_mb * 1024 ** 2, processes)
+    with pd.option_context("display.width", None, "display.float_format", "{:.4g}".format):
+        print(df)
+    if output:
+        df.to_csv(output)
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,10 +1,20 @@
 #!/usr/bin/env python3
-from datetime import date
+import re
+from collections.abc import Generator, Iterable
+from datetime import date, datetime
 from pathlib import Path
+from typing import Optional, Union
 
 import click
+import pandas as pd
+from mypy_boto3_s3.service_resource import ObjectSummary
 
-from admeasure_py.utils import download_files_from_s3, normalize_id, s3_bucket, json
+from admeasure_py import profiling
+from admeasure_py.index import index_plans, plan_attributes
+from admeasure_py.packed import PackedStore
+from admeasure_py.pipeline import fetch, pipeline_options
+from admeasure_py.stages import Memo
+from admeasure_py.utils import cache_backend, list_objects, normalize_id, read_json
 
 today = date.today().isoformat()
 
@@ -18,42 +28,186 @@ def cli():
     pass
 
 
-def log_files_for_prefix(prefix: str, job: bool = True, site: bool = True) -> tuple[dict[str, Path], dict[str, Path]]:
-    prefix = normalize_id(prefix)
-    bucket = s3_bucket()
+def is_job_file(key: str) -> bool:
+    return key.endswith("measure.json") or key.endswith("prime.json")
 
-    s3_site_files = []
-    s3_job_files = []
-    for file in bucket.objects.filter(Prefix=prefix):
-        if site and file.key.endswith("console.json"):
-            s3_site_files.append(file)
-        if job and file.key.endswith("measure.json") or file.key.endswith("prime.json"):
-            s3_job_files.append(file)
 
-    print(f"{len(s3_site_files) + len(s3_job_files)} log files found.")
+def log_objects(prefix: str, job: bool = True, site: bool = True) -> Generator[ObjectSummary]:
+    with profiling.span("list"):
+        for file in list_objects(normalize_id(prefix)):
+            if site and file.key.endswith("console.json"):
+                yield file
+            if job and is_job_file(file.key):
+                yield file
 
-    site_files = download_files_from_s3(cache_dir, s3_site_files)
-    job_files = download_files_from_s3(cache_dir, s3_job_files)
 
-    return site_files, job_files
+def log_entry(entry: dict, part: str = "") -> dict:
+    """Normalize log entries from older runner versions ({type, text} and {part, message, timestamp})."""
+    if "text" in entry and "time" in entry:
+        return entry
+    return {
+        # the oldest format only marks the runner's own messages as "admeasure".
+        "part": entry.get("part") or (part if entry.get("type") == "admeasure" else entry.get("type", "")),
+        "text": entry.get("text", entry.get("message", "")),
+        "time": entry.get("time", entry.get("timestamp", "")),
+    }
 
 
-@cli.command()
-@click.argument("prefix")
-def show(prefix: str):
-    site_files, job_files = log_files_for_prefix(prefix, True, True)
-
-    logentries = []
-    for f in site_files.values():
-        logentries.extend(
-            x for x in
-            json.loads(f.read_bytes())
-            if x["part"].startswith("measure-") or x["part"].startswith("prime-")
-        )
-    for f in job_files.values():
-        logentries.extend(json.loads(f.read_bytes())["log"])
+def file_log_entries(id: str, f: Path, job: bool) -> list[dict]:
+    if job:
+        return list(map(log_entry, read_json(f)["log"]))
+    part = id.rpartition("/")[0].rpartition("/")[2]
+    return [
+        x for x in
+        (log_entry(e, part) for e in read_json(f))
+        if x["part"].startswith("measure-") or x["part"].startswith("prime-")
+    ]
+
 
+def read_logs(cache: Union[Path, PackedStore], objects: Iterable[ObjectSummary], download_workers: int, workers: int
+              ) -> list[dict]:
+    """
+    The entries of all log objects, sorted by time (and by id for equal times).
+    Files are parsed while the remaining ones are still being downloaded.
+    """
+    entries = dict(fetch(cache, objects, download_workers).map(
+        lambda x: (x[0], file_log_entries(x[0], x[1], is_job_file(x[0]))), workers, name="parse"))
+    logentries = [e for id in sorted(entries) for e in entries[id]]
     logentries.sort(key=lambda e: e["time"])
+    return logentries
+
+
+def grep_file(pattern: str, f: Path, job: bool) -> list[str]:
+    messages = read_json(f)
+    if job:
+        messages = messages["log"]
+    return [
+        message["text"]
+        for message in map(log_entry, messages)
+        if pattern in message["text"].lower()
+    ]
+
+
+def grep_logs(pattern: str, cache: Union[Path, PackedStore], objects: Iterable[ObjectSummary], download_workers: int,
+              workers: int) -> dict[str, list[str]]:
+    """
+    Matching texts per log object, sorted by id. Files are scanned while the remaining ones are still being downloaded.
+    Not memoized: patterns are ad hoc, caching them would only grow stages.sqlite.
+    """
+    pattern = pattern.lower()
+
+    def scan(x) -> tuple[str, list[str]]:
+        id, f = x
+        return id, grep_file(pattern, f, is_job_file(id))
+
+    matches = dict(fetch(cache, objects, download_workers).map(scan, workers, name="scan"))
+    return {id: matches[id] for id in sorted(matches)}
+
+
+# phase markers of a page visit (runner/main.ts), each phase lasts until the next marker that is present.
+PHASES = [
+    ("open", "opening new page..."),
+    ("load", "visit "),
+    ("dialogs", "Looking for dialogs to "),
+    ("tcfapi", "Waiting for __tcfapi..."),
+    ("write", "write out data: "),
+]
+PAGE_DONE = "done."
+# page flags, in addition to "incomplete" (no "done.") and "slow" (see outliers)
+FLAGS = {
+    "global_timeout": "Global timeout after 5min",
+    "load_error": "page load error",
+    "visit_error": "Error visiting site",
+}
+CMP_ID = re.compile(r"TCF data: cmpId (\d+)")
+HISTOGRAM_BINS = [0, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300, float("inf")]
+
+
+def parse_time(t: str) -> float:
+    return datetime.fromisoformat(t.replace("Z", "+00:00")).timestamp()
+
+
+def page_timings(id: str, f: Path) -> Optional[dict]:
+    """Phase durations (seconds) of the page visit logged in a console.json. None for logs without timestamps."""
+    entries = file_log_entries(id, f, False)
+    if not entries or not entries[0]["time"]:
+        return None
+    page_id = id.rpartition("/")[0]
+    row = {"id": page_id, "plan_id": page_id.rpartition("/")[0], "url": None, "cmp": None}
+    marks = {}
+    flags = set()
+    for e in entries:
+        text = e["text"]
+        for phase, marker in PHASES:
+            if phase not in marks and text.startswith(marker):
+                marks[phase] = parse_time(e["time"])
+                if phase == "load":
+                    row["url"] = text[len(marker):].removesuffix("...")
+        if text == PAGE_DONE:
+            marks["done"] = parse_time(e["time"])
+        for flag, marker in FLAGS.items():
+            if marker in text:
+                flags.add(flag)
+        if row["cmp"] is None and (m := CMP_ID.search(text)):
+            row["cmp"] = int(m[1])
+    if "done" not in marks:
+        flags.add("incomplete")
+    end = marks.pop("done", parse_time(entries[-1]["time"]))
+    times = sorted(marks.items(), key=lambda x: x[1])
+    for (phase, start), (_, next_start) in zip(times, [*times[1:], (None, end)]):
+        row[phase] = next_start - start
+    row["total"] = end - marks.get("open", parse_time(entries[0]["time"]))
+    row["flags"] = ",".join(sorted(flags))
+    return row
+
+
+def page_frame(rows: list[dict], plans: pd.DataFrame) -> pd.DataFrame:
+    """One row per page with phase durations, joined with region and browser of its plan."""
+    df = pd.DataFrame(rows, columns=["id", "plan_id", "url", "cmp", *(p for p, _ in PHASES), "total", "flags"])
+    df = df.join(plans[["region", "device"]].rename(columns={"device": "browser"}), on="plan_id")
+    df["cmp"] = df.cmp.map(lambda c: "none" if pd.isna(c) else str(int(c)))
+    return df.sort_values("id").reset_index(drop=True)
+
+
+def phase_durations(pages: pd.DataFrame) -> pd.DataFrame:
+    """long format: one row per page and phase"""
+    return pages.melt(
+        id_vars=["id", "region", "browser", "cmp"],
+        value_vars=[*(p for p, _ in PHASES), "total"],
+        var_name="phase",
+        value_name="seconds",
+    ).dropna(subset=["seconds"])
+
+
+def percentiles(pages: pd.DataFrame, by: str) -> pd.DataFrame:
+    durations = phase_durations(pages)
+    durations[by] = durations[by].fillna("unknown")
+    return durations.groupby([by, "phase"], sort=True).seconds.describe(percentiles=[.5, .9, .99])[
+        ["count", "mean", "50%", "90%", "99%", "max"]
+    ].rename(columns={"50%": "p50", "90%": "p90", "99%": "p99"})
+
+
+def histogram(pages: pd.DataFrame) -> pd.DataFrame:
+    """page count per phase and duration bin"""
+    durations = phase_durations(pages)
+    durations["bin"] = pd.cut(durations.seconds, HISTOGRAM_BINS, right=False)
+    return durations.groupby(["phase", "bin"], observed=False).size().unstack(fill_value=0)
+
+
+def outliers(pages: pd.DataFrame, quantile: float = 0.99) -> pd.DataFrame:
+    """flagged pages and pages slower than the given quantile of all pages"""
+    df = pages.copy()
+    slow = df.total > df.total.quantile(quantile)
+    df.loc[slow, "flags"] = df.loc[slow, "flags"].map(lambda f: ",".join(filter(None, [f, "slow"])))
+    return df[df["flags"] != ""].sort_values("total", ascending=False)
+
+
+@cli.command()
+@click.argument("prefix")
+@pipeline_options
+def show(prefix: str, download_workers: int, workers: int):
+    with cache_backend(cache_dir) as cache:
+        logentries = read_logs(cache, log_objects(prefix), download_workers, workers)
 
     click.echo_via_pager(
         "\n" + click.style(f"[{l['part']}] ", fg="blue") + l['text']
@@ -64,18 +218,73 @@ def show(prefix: str):
 @cli.command()
 @click.argument("pattern")
 @click.argument("prefix", default=f"eval/{today}", required=False)
-def grep(pattern: str, prefix: str):
-    pattern = pattern.lower()
+@pipeline_options
+def grep(pattern: str, prefix: str, download_workers: int, workers: int):
+    with profiling.span("grep"), cache_backend(cache_dir) as cache:
+        matches = grep_logs(pattern, cache, log_objects(prefix), download_workers, workers)
+    for id, texts in matches.items():
+        for text in texts:
+            print(click.style(f"[{id.rpartition('/')[0]}]", fg="cyan"), text)
+
+
+@cli.command()
+@click.argument("prefix")
+@click.option("--by", multiple=True, type=click.Choice(["region", "browser", "cmp"]),
+              default=["region", "browser", "cmp"], show_default=True, help="dimensions for percentiles.")
+@click.option("--quantile", default=0.99, show_default=True, help="pages slower than this quantile are outliers.")
+@click.option("-o", "--output", type=click.Path(file_okay=False, path_type=Path), help="write all tables as CSV.")
+@pipeline_options
+def perf(prefix: str, by: list[str], quantile: float, output: Optional[Path], download_workers: int, workers: int):
+    """page phase durations from runner console timestamps."""
+    s3_plan_files = []
+
+    def console_objects():
+        # plan.json is collected in the same listing, for region and browser.
+        with profiling.span("list"):
+            for file in list_objects(normalize_id(prefix)):
+                if file.key.endswith("console.json"):
+                    yield file
+                elif file.key.endswith("plan.json"):
+                    s3_plan_files.append(file)
+
+    memo = Memo(here / "stages.sqlite")
+    page = memo.stage("log.perf.page").cached_files(page_timings)
+    rows = []
+    with cache_backend(cache_dir) as cache:
+        for _, row in fetch(cache, console_objects(), download_workers).map(page, workers, name="timings"):
+            if row is not None:
+                rows.append(row)
+
+    if not rows:
+        print("No timestamped page logs found.")
+        return
+    index_plans(s3_plan_files, urls=False)
+    pages = page_frame(rows, plan_attributes())
+    tables = {
+        "pages": pages,
+        "histogram": histogram(pages),
+        **{f"percentiles_{b}": percentiles(pages, b) for b in by},
+        "outliers": outliers(pages, quantile),
+    }
 
-    site_files, job_files = log_files_for_prefix(prefix, True, True)
+    phases = [p for p, _ in PHASES]
+    print(f"{len(pages)} pages, {pages.total.sum() / 3600:.1f}h total.")
+    with pd.option_context("display.max_rows", 200, "display.width", None, "display.float_format", "{:.2f}".format):
+        click.secho("# share of total page time per phase", fg="green")
+        print((pages[phases].sum() / pages[phases].sum().sum()).to_string())
+        click.secho("# histogram (pages per duration bin, seconds)", fg="green")
+        print(tables["histogram"])
+        for b in by:
+            click.secho(f"# percentiles by {b} (seconds)", fg="green")
+            print(tables[f"percentiles_{b}"])
+        click.secho(f"# outliers ({len(tables['outliers'])})", fg="green")
+        print(tables["outliers"].head(20)[["id", "url", "cmp", "total", "flags"]].to_string(index=False))
 
-    for id, f in sorted(list(site_files.items()) + list(job_files.items())):
-        messages = json.loads(f.read_bytes())
-        if id in job_files:
-            messages = messages["log"]
-        for message in messages:
-            if pattern in message["text"].lower():
-                print(click.style(f"[{id.rpartition('/')[0]}]", fg="cyan"), message["text"])
+    if output:
+        output.mkdir(parents=True, exist_ok=True)
+        for name, df in tables.items():
+            df.to_csv(output / f"{name}.csv", index=name != "pages")
+        print(f"Tables written to {output}.")
 
 
 if __name__ == "__main__":